@@ -8,65 +8,75 @@ import os
 import re
 import datetime
 from qgis.PyQt import QtWidgets, uic
-from qgis.core import (
-    QgsVectorLayer,
-    QgsProject,
-    QgsFeature,
-    QgsGeometry,
-    QgsFields,
-    QgsField,
-    QgsWkbTypes,
-)
-from PyQt5.QtCore import QVariant
+from PyQt5.QtCore import Qt, QStringListModel, QSettings
 import geopandas as gpd
 
 # Importa funzione scarica ed estrai dataset catastale
 from .scarica_dati import scarica_e_scompatta_dataset
+from .lettura_catastale import (
+    LIMITE_MEMORIA_MB,
+    chiave_etichetta,
+    trova_file_gml,
+)
+from .ricerca_catastale import ErroreRicerca, carica_dati_comune, cerca_particelle
+from .indice_comuni import cerca_comuni, costruisci_indice_comuni, descrizione_comune
+from .indice_catastale import (
+    carica_grafo_confinanti,
+    carica_indice,
+    carica_panoramica,
+    fogli_comune,
+    geometrie_per_posizione,
+    particelle_con_confinanti,
+)
+from .layer_catastali import (
+    accumula_in_layer,
+    aggiungi_gruppo_panoramica,
+    aggiungi_layer_progetto,
+    crea_layer_memoria,
+)
+from .geometrie_catastali import LIVELLI_PANORAMICA, SCALA_DETTAGLIO, dissolvi_particelle, nome_livello
+from .variazioni_catastali import STATI_VARIAZIONE, carica_variazioni
+from .GeocodificaTabella_dialog import GeocodificaTabellaDialog
+from .esporta_catastali import DRIVER_PER_ESTENSIONE, esporta_particelle, geometria_foglio
 
 # Percorso base relativo alla cartella del plugin
 PLUGIN_DIR = os.path.dirname(__file__)
 BASE_DIR = os.path.join(PLUGIN_DIR, 'Sardegna')
 
+# Chiave QSettings del limite di memoria (MB) oltre cui i GML sono letti a blocchi
+CHIAVE_LIMITE_MEMORIA = 'GeocodificaCatastali/limite_memoria_mb'
+
 # Caricamento del file UI creato con Qt Designer
 FORM_CLASS, _ = uic.loadUiType(
     os.path.join(os.path.dirname(__file__), 'GeocodificaIndirizzo_dialog_base.ui')
 )
 
-# ----------------- Utility per colonne/CRS -----------------
+# ----------------- Autocompletamento -----------------
 
-def _pick_column(df, aliases):
+class _ParticelleCompleter(QtWidgets.QCompleter):
     """
-    Restituisce il nome della prima colonna in df che corrisponde (case-insensitive)
-    a uno degli alias forniti. Gestisce eventuali suffissi '_1', '_2' tipici di overlay.
+    Completer per elenchi separati da virgola: completa solo l'ultima
+    particella digitata mantenendo invariate le precedenti.
     """
-    cols = list(df.columns)
 
-    def base_name(name: str) -> str:
-        n = name.lower()
-        for suf in ("_1", "_2"):
-            if n.endswith(suf):
-                return n[:-len(suf)]
-        return n
+    def splitPath(self, path):
+        return [path.split(",")[-1].strip()]
 
-    aliases_low = [a.lower() for a in aliases]
+    def pathFromIndex(self, index):
+        completamento = super().pathFromIndex(index)
+        testo = self.widget().text() if self.widget() else ""
+        precedenti = [p.strip() for p in testo.split(",")[:-1] if p.strip()]
+        return ", ".join(precedenti + [completamento])
 
-    # Match diretto sull'elenco colonne (dopo normalizzazione)
-    for col in cols:
-        if base_name(col) in aliases_low:
-            return col
 
-    # Fallback: match "contains" per maggiore tolleranza
-    for col in cols:
-        b = base_name(col)
-        if any(b == a or a in b for a in aliases_low):
-            return col
-
-    return None
-
-
-def _friendly_cols(df):
-    """Ritorna stringa con l'elenco delle colonne (per messaggi d'errore)."""
-    return ", ".join(map(str, df.columns))
+def _crea_completer(completer_cls, parent):
+    """Crea un completer (prefisso, case-insensitive) con modello vuoto."""
+    completer = completer_cls(parent)
+    completer.setModel(QStringListModel(parent))
+    completer.setCaseSensitivity(Qt.CaseInsensitive)
+    completer.setFilterMode(Qt.MatchStartsWith)
+    completer.setCompletionMode(QtWidgets.QCompleter.PopupCompletion)
+    return completer
 
 
 # ----------------- Dialog principale -----------------
@@ -116,12 +126,55 @@ class GeocodificaCatastaliDialog(QtWidgets.QDialog, FORM_CLASS):
             self.particellaEdit.clear()
             self.particellaEdit.setPlaceholderText("digitare n. particella/e (separate da una virgola) ...")
 
+        # Ricerca comuni in tutta la Sardegna (indice in memoria, suggerimenti non filtrati da Qt)
+        self._indice_comuni = []
+        self._suggerimenti_comuni = {}
+        if hasattr(self, 'cercaComuneEdit'):
+            self.cercaComuneEdit.clear()
+            self.cercaComuneEdit.setPlaceholderText("nome o codice catastale del comune ...")
+            self.cercaComuneCompleter = _crea_completer(QtWidgets.QCompleter, self)
+            self.cercaComuneCompleter.setCompletionMode(QtWidgets.QCompleter.UnfilteredPopupCompletion)
+            self.cercaComuneEdit.setCompleter(self.cercaComuneCompleter)
+            self.cercaComuneEdit.textEdited.connect(self.on_cerca_comune_edited)
+            self.cercaComuneCompleter.activated[str].connect(self.on_comune_cercato)
+
+        # Autocompletamento foglio/particelle da indice precalcolato
+        if hasattr(self, 'foglioEdit'):
+            self.foglioCompleter = _crea_completer(QtWidgets.QCompleter, self)
+            self.foglioEdit.setCompleter(self.foglioCompleter)
+            self.foglioEdit.textChanged.connect(self.on_foglio_changed)
+        if hasattr(self, 'particellaEdit'):
+            self.particellaCompleter = _crea_completer(_ParticelleCompleter, self)
+            self.particellaEdit.setCompleter(self.particellaCompleter)
+
         # Collegamenti dipendenze tra campi
         if hasattr(self, 'provinciaCombo'):
             self.provinciaCombo.currentIndexChanged.connect(self.on_provincia_changed)
         if hasattr(self, 'comuneCombo'):
             self.comuneCombo.currentIndexChanged.connect(self.on_comune_changed)
 
+        # Pulsante "Esporta foglio/comune"
+        if hasattr(self, 'esportaBtn'):
+            self.esportaBtn.clicked.connect(self.esporta_dati)
+
+        # Pulsante "Variazioni ultimo aggiornamento"
+        if hasattr(self, 'variazioniBtn'):
+            self.variazioniBtn.clicked.connect(self.mostra_variazioni)
+
+        # Pulsante "Geocodifica tabella"
+        self._dialog_tabella = None
+        if hasattr(self, 'tabellaBtn'):
+            self.tabellaBtn.clicked.connect(self.apri_geocodifica_tabella)
+
+        # Pulsante "Panoramica comune"
+        if hasattr(self, 'panoramicaBtn'):
+            self.panoramicaBtn.clicked.connect(self.carica_panoramica_comune)
+
+        # Limite di memoria per la lettura dei GML, salvato nelle impostazioni di QGIS
+        if hasattr(self, 'limiteMemoriaSpin'):
+            self.limiteMemoriaSpin.setValue(self._limite_memoria_mb())
+            self.limiteMemoriaSpin.valueChanged.connect(self.on_limite_memoria_changed)
+
         # Pulsante "Scarica Dati"
         if hasattr(self, 'scaricaDatiBtn'):
             self.scaricaDatiBtn.clicked.connect(self.scarica_dati)
@@ -142,6 +195,9 @@ class GeocodificaCatastaliDialog(QtWidgets.QDialog, FORM_CLASS):
 
     # Ripristina lo stato iniziale dei campi/controlli
     def reset_fields(self):
+        if hasattr(self, 'cercaComuneEdit'):
+            self.cercaComuneEdit.clear()
+
         if hasattr(self, 'provinciaCombo'):
             self.provinciaCombo.blockSignals(True)
             self.provinciaCombo.clear()
@@ -166,6 +222,8 @@ class GeocodificaCatastaliDialog(QtWidgets.QDialog, FORM_CLASS):
             self.particellaEdit.clear()
             self.particellaEdit.setPlaceholderText("digitare n. particella/e (separate da una virgola) ...")
 
+        self.aggiorna_completamento_fogli()
+
         if hasattr(self, 'progressBar'):
             self.progressBar.hide()
             self.progressBar.setValue(0)
@@ -205,6 +263,27 @@ class GeocodificaCatastaliDialog(QtWidgets.QDialog, FORM_CLASS):
             self.particellaEdit.setPlaceholderText("digitare n. particella/e (separate da una virgola) ...")
 
         self.carica_comuni(popola_senza_selezionare=True)
+        self.aggiorna_completamento_fogli()
+
+    # Digitazione nella ricerca comuni: aggiorna i suggerimenti (prefisso + fuzzy)
+    def on_cerca_comune_edited(self, testo):
+        risultati = cerca_comuni(self._indice_comuni, testo)
+        self._suggerimenti_comuni = {descrizione_comune(v): v for v in risultati}
+        self.cercaComuneCompleter.model().setStringList(list(self._suggerimenti_comuni))
+
+    # Scelta di un suggerimento: imposta provincia e comune
+    def on_comune_cercato(self, testo):
+        voce = self._suggerimenti_comuni.get(testo)
+        if not voce or not hasattr(self, 'provinciaCombo') or not hasattr(self, 'comuneCombo'):
+            return
+        indice_provincia = self.provinciaCombo.findText(voce["provincia"])
+        if indice_provincia < 0:
+            return
+        if indice_provincia != self.provinciaCombo.currentIndex():
+            self.provinciaCombo.setCurrentIndex(indice_provincia)  # ricarica i comuni
+        indice_comune = self.comuneCombo.findText(voce["cartella"])
+        if indice_comune >= 0:
+            self.comuneCombo.setCurrentIndex(indice_comune)
 
     # Cambio comune: azzera campi foglio/particelle
     def on_comune_changed(self):
@@ -218,6 +297,73 @@ class GeocodificaCatastaliDialog(QtWidgets.QDialog, FORM_CLASS):
             self.particellaEdit.clear()
             self.particellaEdit.setPlaceholderText("digitare n. particella/e (separate da una virgola) ...")
 
+        self.aggiorna_completamento_fogli()
+
+    # Cambio foglio: aggiorna l'autocompletamento delle particelle
+    def on_foglio_changed(self):
+        if not hasattr(self, 'particellaCompleter'):
+            return
+        comune_dir = self._comune_dir_corrente()
+        foglio = self.foglioEdit.text().strip()
+        particelle = []
+        if comune_dir and foglio:
+            # Solo da indice già caricato: nessuna lettura GML durante la digitazione
+            indice = carica_indice(comune_dir, costruisci_se_mancante=False)
+            if indice:
+                particelle = indice["particelle"].get(foglio, [])
+        self.particellaCompleter.model().setStringList(particelle)
+
+    # Cartella del comune selezionato (None se provincia/comune non scelti)
+    def _comune_dir_corrente(self):
+        if not hasattr(self, 'provinciaCombo') or not hasattr(self, 'comuneCombo'):
+            return None
+        provincia = self.provinciaCombo.currentText().strip()
+        comune = self.comuneCombo.currentText().strip()
+        if not provincia or not comune:
+            return None
+        comune_dir = os.path.join(BASE_DIR, provincia, comune)
+        return comune_dir if os.path.isdir(comune_dir) else None
+
+    # Limite di memoria configurato (QSettings), con valore predefinito del modulo di lettura
+    def _limite_memoria_mb(self):
+        try:
+            return int(QSettings().value(CHIAVE_LIMITE_MEMORIA, LIMITE_MEMORIA_MB))
+        except (TypeError, ValueError):
+            return LIMITE_MEMORIA_MB
+
+    # Nuovo limite dal campo MEMORIA: salvato subito, vale per le letture successive
+    def on_limite_memoria_changed(self, valore):
+        QSettings().setValue(CHIAVE_LIMITE_MEMORIA, int(valore))
+
+    # Carica l'elenco fogli del comune selezionato nell'autocompletamento
+    def aggiorna_completamento_fogli(self):
+        if not hasattr(self, 'foglioCompleter'):
+            return
+        comune_dir = self._comune_dir_corrente()
+        fogli = []
+        if comune_dir:
+            # Il primo accesso a un comune senza indice (es. dati scaricati prima
+            # dell'introduzione dell'indice) richiede la lettura dei GML: avviso nella progressBar
+            da_costruire = carica_indice(comune_dir, costruisci_se_mancante=False) is None
+            if da_costruire and hasattr(self, "progressBar"):
+                self.progressBar.setValue(0)
+                self.progressBar.setFormat(f"Creazione indice di {os.path.basename(comune_dir)} "
+                                           "(solo al primo utilizzo)...")
+                self.progressBar.show()
+                QtWidgets.QApplication.processEvents()
+            QtWidgets.QApplication.setOverrideCursor(Qt.WaitCursor)
+            try:
+                fogli = fogli_comune(comune_dir, self._limite_memoria_mb())
+            except Exception as e:
+                print(f"Indice non disponibile per {comune_dir}: {e}")
+            finally:
+                QtWidgets.QApplication.restoreOverrideCursor()
+                if da_costruire and hasattr(self, "progressBar"):
+                    self.progressBar.hide()
+        self.foglioCompleter.model().setStringList(fogli)
+        if hasattr(self, 'particellaCompleter'):
+            self.particellaCompleter.model().setStringList([])
+
     # Aggiorna la label dell'ultimo aggiornamento o la progressBar come fallback
     def mostra_data_ultimo_aggiornamento(self):
         sardegna_dir = BASE_DIR
@@ -240,8 +386,10 @@ class GeocodificaCatastaliDialog(QtWidgets.QDialog, FORM_CLASS):
             self.progressBar.setFormat(testo)
             self.progressBar.setValue(0 if 'Aggiorna i dati' in testo else 100)
 
-    # Popola l'elenco province (senza selezione automatica)
+    # Popola l'elenco province (senza selezione automatica) e l'indice dei comuni
     def carica_province(self):
+        # Unica scansione della base dati: comuni di tutte le province in memoria
+        self._indice_comuni = costruisci_indice_comuni(BASE_DIR)
         if not hasattr(self, 'provinciaCombo'):
             return
         self.provinciaCombo.blockSignals(True)
@@ -268,11 +416,8 @@ class GeocodificaCatastaliDialog(QtWidgets.QDialog, FORM_CLASS):
             provincia_selezionata = self.provinciaCombo.currentText().strip()
             if not provincia_selezionata:
                 return
-            provincia_dir = os.path.join(BASE_DIR, provincia_selezionata)
-            if not os.path.isdir(provincia_dir):
-                return
-            comuni = [d for d in os.listdir(provincia_dir) if os.path.isdir(os.path.join(provincia_dir, d))]
-            comuni.sort()
+            # Comuni dall'indice in memoria (nessuna scansione delle cartelle)
+            comuni = sorted(v["cartella"] for v in self._indice_comuni if v["provincia"] == provincia_selezionata)
             self.comuneCombo.addItems(comuni)
             self.comuneCombo.setCurrentIndex(0)
         finally:
@@ -304,166 +449,348 @@ class GeocodificaCatastaliDialog(QtWidgets.QDialog, FORM_CLASS):
             return
 
         # Individuazione file catastali _map.gml e _ple.gml
-        map_file, ple_file = None, None
-        for filename in os.listdir(comune_dir):
-            if filename.endswith('_map.gml'):
-                map_file = os.path.join(comune_dir, filename)
-            elif filename.endswith('_ple.gml'):
-                ple_file = os.path.join(comune_dir, filename)
+        map_file, ple_file = trova_file_gml(comune_dir)
 
         if not map_file or not ple_file:
             QtWidgets.QMessageBox.critical(self, "Errore",
                                            "File catastali '_map.gml' o '_ple.gml' non trovati nella cartella.")
             return
 
-        # Lettura GML
+        # Parsing particelle multiple (separate da virgola)
+        particelle_list = [p.strip() for p in re.split(r',', num_particella) if p.strip()]
+        if not particelle_list:
+            QtWidgets.QMessageBox.warning(self, "Particelle non valide",
+                                          "Inserire almeno una particella (separate da virgola).")
+            return
+
+        # Particelle + anelli di confinanti: risposta dal grafo precalcolato
+        anelli = self.confinantiSpin.value() if hasattr(self, 'confinantiSpin') else 0
+        if anelli > 0:
+            self._carica_confinanti(comune_dir, nome_comune, num_foglio, particelle_list, anelli)
+            return
+
+        # Lettura GML (filtro PARTICELLA applicato in lettura: con i GML più grandi
+        # del limite di memoria il file è letto a blocchi) e ricerca foglio/particelle
         try:
-            gdf_map = gpd.read_file(map_file)
-            gdf_ple = gpd.read_file(ple_file)
+            gdf_fogli, gdf_particelle = carica_dati_comune(comune_dir, particelle_list, self._limite_memoria_mb())
+            particelle_in_foglio, mancanti = cerca_particelle(gdf_fogli, gdf_particelle, num_foglio, particelle_list)
+        except ErroreRicerca as e:
+            if e.critico:
+                QtWidgets.QMessageBox.critical(self, e.titolo, e.messaggio)
+            else:
+                QtWidgets.QMessageBox.warning(self, e.titolo, e.messaggio)
+            return
+
+        # Avviso su eventuali particelle richieste ma non intersecanti/assenti
+        if mancanti:
+            QtWidgets.QMessageBox.information(
+                self, "Avviso",
+                "Le seguenti particelle richieste non sono state trovate nel foglio o non intersecano: "
+                + ", ".join(mancanti)
+            )
+
+        trovate = set(particelle_list) - set(mancanti)
+
+        # Nome layer: Comune + Foglio + elenco particelle realmente caricate
+        particelle_label = ", ".join(sorted(trovate, key=chiave_etichetta)) if trovate else num_particella
+        layer_name = f"{nome_comune} - F. {num_foglio} - P. {particelle_label}"
+
+        self._carica_risultato(particelle_in_foglio, nome_comune, layer_name)
+
+    def _carica_confinanti(self, comune_dir, nome_comune, num_foglio, particelle_list, anelli):
+        """
+        Carica le particelle richieste più "anelli" livelli di confinanti,
+        individuate sul grafo di adiacenza del comune e lette per posizione
+        dalle geometrie salvate con il grafo.
+        """
+        errore = None
+        QtWidgets.QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            grafo = carica_grafo_confinanti(comune_dir, limite_memoria_mb=self._limite_memoria_mb())
         except Exception as e:
+            grafo, errore = None, e
+        finally:
+            QtWidgets.QApplication.restoreOverrideCursor()
+        if grafo is None:
+            dettagli = f"\n\nDettagli: {errore}" if errore else ""
             QtWidgets.QMessageBox.critical(self, "Errore",
-                                           f"Errore caricamento file GML:\n{str(e)}")
+                                           "Grafo delle particelle confinanti non disponibile." + dettagli)
             return
 
-        # Risoluzione nomi colonna (FOGLIO e PARTICELLA)
-        aliases_foglio = ["label", "foglio", "codfoglio", "cod_foglio", "num_foglio", "n_foglio", "foglio_n"]
-        aliases_particella = ["label", "particella", "numero", "num_part", "n_part", "num_particella",
-                              "ident", "identificativo", "id_particella"]
-
-        col_foglio = _pick_column(gdf_map, aliases_foglio)
-        if not col_foglio:
-            QtWidgets.QMessageBox.critical(
-                self, "Campo FOGLIO non trovato",
-                "Impossibile individuare la colonna del FOGLIO nel file _map.gml.\n"
-                f"Colonne disponibili: { _friendly_cols(gdf_map) }"
+        distanze = particelle_con_confinanti(grafo, num_foglio, particelle_list, anelli)
+        if not distanze:
+            QtWidgets.QMessageBox.warning(
+                self, "Particelle non trovate",
+                f"Nessuna delle particelle richieste ({', '.join(particelle_list)}) "
+                f"è presente nel foglio {num_foglio}."
             )
             return
 
-        col_part = _pick_column(gdf_ple, aliases_particella)
-        if not col_part:
-            QtWidgets.QMessageBox.critical(
-                self, "Campo PARTICELLA non trovato",
-                "Impossibile individuare la colonna della PARTICELLA nel file _ple.gml.\n"
-                f"Colonne disponibili: { _friendly_cols(gdf_ple) }"
-            )
+        try:
+            selezione = geometrie_per_posizione(comune_dir, distanze, self._limite_memoria_mb())
+        except Exception as e:
+            QtWidgets.QMessageBox.critical(self, "Errore",
+                                           f"Errore caricamento geometrie:\n{str(e)}")
             return
 
-        # Copie minimali con rinomina per evitare suffissi dopo overlay
-        gdf_map_min = gdf_map[[col_foglio, "geometry"]].copy().rename(columns={col_foglio: "FOGLIO"})
-        gdf_ple_min = gdf_ple[[col_part, "geometry"]].copy().rename(columns={col_part: "PARTICELLA"})
+        posizioni = selezione.index.to_numpy()
+        risultato = gpd.GeoDataFrame(
+            {
+                "FOGLIO": grafo["foglio"][posizioni],
+                "PARTICELLA": grafo["particella"][posizioni],
+                "ANELLO": [distanze[int(p)] for p in posizioni],
+            },
+            geometry=selezione.geometry.values,
+            crs=selezione.crs,
+        ).sort_values("ANELLO", kind="stable")
+
+        trovate = set(risultato.loc[risultato["ANELLO"] == 0, "PARTICELLA"])
+        mancanti = set(particelle_list) - trovate
+        if mancanti:
+            QtWidgets.QMessageBox.information(
+                self, "Avviso",
+                "Le seguenti particelle richieste non sono state trovate nel foglio: "
+                + ", ".join(sorted(mancanti, key=chiave_etichetta))
+            )
 
-        # Filtro FOGLIO
-        foglio_sel = gdf_map_min[gdf_map_min["FOGLIO"].astype(str).str.strip() == str(num_foglio).strip()]
-        if foglio_sel.empty:
-            QtWidgets.QMessageBox.warning(
-                self, "Foglio non trovato",
-                f"Foglio '{num_foglio}' non trovato.\n"
-                f"(Campo usato: FOGLIO; esempi presenti: "
-                f"{', '.join(map(str, gdf_map_min['FOGLIO'].astype(str).unique()[:10]))} ... )"
+        particelle_label = ", ".join(sorted(trovate, key=chiave_etichetta))
+        layer_name = f"{nome_comune} - F. {num_foglio} - P. {particelle_label} + confinanti ({anelli})"
+        self._carica_risultato(risultato, nome_comune, layer_name)
+
+    def _carica_risultato(self, gdf, nome_comune, layer_name):
+        """Carica il GeoDataFrame risultato come nuovo layer o nel layer di sessione del comune."""
+        # Opzione "dissolve": un unico poligono con il perimetro esterno della selezione
+        if hasattr(self, 'dissolviCheck') and self.dissolviCheck.isChecked():
+            try:
+                gdf = dissolvi_particelle(gdf)
+            except Exception as e:
+                QtWidgets.QMessageBox.critical(self, "Errore spaziale",
+                                               f"Errore durante l'unione delle particelle:\n{e}")
+                return
+            layer_name = f"{layer_name} (unione)"
+
+        # Modalità "accumula": un solo layer per comune, aggiornato per (foglio, particella)
+        if hasattr(self, 'accumulaCheck') and self.accumulaCheck.isChecked():
+            layer, aggiunte, aggiornate, invariate = accumula_in_layer(
+                gdf, f"{nome_comune} - Particelle"
+            )
+            QtWidgets.QMessageBox.information(
+                self, "Successo",
+                f"Layer '{layer.name()}' aggiornato: {aggiunte} particelle aggiunte, "
+                f"{aggiornate} aggiornate, {invariate} già presenti."
             )
             return
 
-        # Parsing particelle multiple (separate da virgola)
-        particelle_list = [p.strip() for p in re.split(r',', num_particella) if p.strip()]
-        if not particelle_list:
-            QtWidgets.QMessageBox.warning(self, "Particelle non valide",
-                                          "Inserire almeno una particella (separate da virgola).")
+        # ----------------- Creazione layer QGIS in memoria -----------------
+
+        mem_layer = crea_layer_memoria(gdf, layer_name)
+
+        # Aggiunge il layer al progetto (sostituendo eventuali omonimi)
+        aggiungi_layer_progetto(mem_layer)
+
+        QtWidgets.QMessageBox.information(self, "Successo",
+                                          f"Layer '{mem_layer.name()}' caricato correttamente.")
+
+    # ----------------- Esportazione foglio/comune -----------------
+
+    def esporta_dati(self):
+        """
+        Esporta in streaming tutte le particelle del foglio indicato
+        (o dell'intero comune se il foglio è vuoto) in GeoPackage o Shapefile.
+        """
+        comune_dir = self._comune_dir_corrente()
+        if not comune_dir:
+            QtWidgets.QMessageBox.warning(self, "Input Mancante",
+                                          "Selezionare provincia e comune da esportare.")
             return
 
-        # Filtro PARTICELLA
-        particella_sel = gdf_ple_min[gdf_ple_min["PARTICELLA"].astype(str).str.strip().isin(particelle_list)]
-        if particella_sel.empty:
-            QtWidgets.QMessageBox.warning(
-                self, "Particelle non trovate",
-                f"Nessuna delle particelle richieste ({', '.join(particelle_list)}) è presente."
+        nome_comune = self.comuneCombo.currentText().strip()
+        num_foglio = self.foglioEdit.text().strip() if hasattr(self, 'foglioEdit') else ""
+
+        map_file, ple_file = trova_file_gml(comune_dir)
+        if not map_file or not ple_file:
+            QtWidgets.QMessageBox.critical(self, "Errore",
+                                           "File catastali '_map.gml' o '_ple.gml' non trovati nella cartella.")
+            return
+
+        if not num_foglio:
+            risposta = QtWidgets.QMessageBox.question(
+                self, "Esporta comune",
+                f"Nessun foglio indicato: esportare tutte le particelle del comune {nome_comune}?"
             )
+            if risposta != QtWidgets.QMessageBox.Yes:
+                return
+
+        nome_file = f"{nome_comune}-F.{num_foglio}" if num_foglio else nome_comune
+        dest_path, _ = QtWidgets.QFileDialog.getSaveFileName(
+            self, "Esporta particelle", nome_file + ".gpkg",
+            "GeoPackage (*.gpkg);;ESRI Shapefile (*.shp)"
+        )
+        if not dest_path:
             return
+        estensione = os.path.splitext(dest_path)[1].lower()
+        if estensione not in DRIVER_PER_ESTENSIONE:
+            dest_path += ".gpkg"
+            estensione = ".gpkg"
+
+        # Foglio: geometria di filtro e numero atteso di particelle (dall'indice)
+        geometria_filtro, totale_previsto = None, None
+        if num_foglio:
+            try:
+                geometria_filtro = geometria_foglio(map_file, num_foglio)
+            except Exception as e:
+                QtWidgets.QMessageBox.critical(self, "Errore", str(e))
+                return
+            if geometria_filtro is None:
+                QtWidgets.QMessageBox.warning(self, "Foglio non trovato",
+                                              f"Foglio '{num_foglio}' non presente nel file '_map.gml'.")
+                return
+            indice = carica_indice(comune_dir, costruisci_se_mancante=False)
+            if indice:
+                totale_previsto = len(indice["particelle"].get(num_foglio, [])) or None
+
+        for obj in ('esportaBtn', 'buttonBox', 'scaricaDatiBtn'):
+            if hasattr(self, obj):
+                getattr(self, obj).setEnabled(False)
+        if hasattr(self, "progressBar"):
+            self.progressBar.setValue(0)
+            self.progressBar.setFormat("Esportazione in corso...")
+            self.progressBar.show()
+
+        def avanzamento(scritte, totale):
+            if hasattr(self, "progressBar"):
+                if totale:
+                    self.progressBar.setValue(min(100, int(scritte * 100 / totale)))
+                self.progressBar.setFormat(f"Esportate {scritte} particelle" + (f" di {totale}" if totale else ""))
+            QtWidgets.QApplication.processEvents()
 
-        # Intersezione spaziale: particelle ∩ foglio
         try:
-            particelle_in_foglio = gpd.overlay(particella_sel, foglio_sel, how='intersection')
+            scritte = esporta_particelle(ple_file, dest_path, DRIVER_PER_ESTENSIONE[estensione],
+                                         geometria_filtro=geometria_filtro,
+                                         totale_previsto=totale_previsto,
+                                         progress_cb=avanzamento)
         except Exception as e:
-            QtWidgets.QMessageBox.critical(self, "Errore spaziale",
-                                           f"Errore durante l'intersezione spaziale:\n{e}")
+            QtWidgets.QMessageBox.critical(self, "Errore esportazione",
+                                           f"Errore durante l'esportazione:\n{dest_path}\n\nDettagli: {e}")
             return
+        finally:
+            for obj in ('esportaBtn', 'buttonBox', 'scaricaDatiBtn'):
+                if hasattr(self, obj):
+                    getattr(self, obj).setEnabled(True)
+            if hasattr(self, "progressBar"):
+                self.progressBar.hide()
+            self.mostra_data_ultimo_aggiornamento()
+
+        QtWidgets.QMessageBox.information(self, "Esportazione completata",
+                                          f"{scritte} particelle esportate in:\n{dest_path}")
 
-        if particelle_in_foglio.empty:
-            QtWidgets.QMessageBox.warning(self, "Errore spaziale",
-                                          "Le particelle selezionate non ricadono nel foglio indicato.")
+    # ----------------- Variazioni tra rilasci -----------------
+
+    def mostra_variazioni(self):
+        """
+        Carica come layer le particelle del comune aggiunte, modificate e rimosse
+        con l'ultimo aggiornamento (report calcolato in fase di scaricamento).
+        Le particelle rimosse non hanno geometria nel rilascio attuale.
+        """
+        comune_dir = self._comune_dir_corrente()
+        if not comune_dir:
+            QtWidgets.QMessageBox.warning(self, "Input Mancante",
+                                          "Selezionare provincia e comune.")
             return
+        nome_comune = self.comuneCombo.currentText().strip()
 
-        # Avviso su eventuali particelle richieste ma non intersecanti/assenti
-        trovate = set(particelle_in_foglio["PARTICELLA"].astype(str).str.strip().unique())
-        richieste = set(particelle_list)
-        mancanti = richieste - trovate
-        if mancanti:
+        variazioni = carica_variazioni(comune_dir)
+        if variazioni is None:
             QtWidgets.QMessageBox.information(
-                self, "Avviso",
-                "Le seguenti particelle richieste non sono state trovate nel foglio o non intersecano: "
-                + ", ".join(sorted(mancanti))
+                self, "Variazioni",
+                "Nessun confronto disponibile per questo comune: le variazioni sono calcolate "
+                "dal secondo aggiornamento dei dati in poi."
             )
+            return
+        if variazioni.empty:
+            QtWidgets.QMessageBox.information(self, "Variazioni",
+                                              f"Nessuna particella variata a {nome_comune} con l'ultimo aggiornamento.")
+            return
 
-        # ----------------- Creazione layer QGIS in memoria -----------------
+        posizioni = variazioni.loc[variazioni["POSIZIONE"] >= 0, "POSIZIONE"].tolist()
+        try:
+            geometrie = geometrie_per_posizione(comune_dir, posizioni, self._limite_memoria_mb())
+        except Exception as e:
+            QtWidgets.QMessageBox.critical(self, "Errore",
+                                           f"Errore caricamento geometrie:\n{str(e)}")
+            return
 
-        # Tipo geometrico: MultiPolygon se presente
-        geom_types = particelle_in_foglio.geom_type.unique().tolist()
-        if any(gt == 'MultiPolygon' for gt in geom_types):
-            wkb_type = QgsWkbTypes.MultiPolygon
-        elif any(gt == 'Polygon' for gt in geom_types):
-            wkb_type = QgsWkbTypes.Polygon
-        else:
-            wkb_type = QgsWkbTypes.Unknown
+        risultato = gpd.GeoDataFrame(
+            variazioni[["FOGLIO", "PARTICELLA", "STATO"]],
+            geometry=geometrie.geometry.reindex(variazioni["POSIZIONE"]).values,
+            crs=geometrie.crs,
+        )
+        layer = crea_layer_memoria(risultato, f"{nome_comune} - Variazioni ultimo aggiornamento")
+        aggiungi_layer_progetto(layer)
+
+        conteggi = variazioni["STATO"].value_counts()
+        QtWidgets.QMessageBox.information(
+            self, "Variazioni",
+            f"Layer '{layer.name()}' caricato: "
+            + ", ".join(f"{int(conteggi.get(stato, 0))} {stato}" for stato in STATI_VARIAZIONE)
+            + "."
+        )
+
+    def carica_panoramica_comune(self):
+        """
+        Carica l'intero comune come gruppo di layer con visibilità per scala:
+        geometrie semplificate a scala piccola, GML originali solo a scala
+        ravvicinata. Le panoramiche sono generate al primo utilizzo se mancano.
+        """
+        comune_dir = self._comune_dir_corrente()
+        if not comune_dir:
+            QtWidgets.QMessageBox.warning(self, "Input Mancante",
+                                          "Selezionare provincia e comune.")
+            return
+        nome_comune = self.comuneCombo.currentText().strip()
 
-        # CRS dal GeoDataFrame oppure EPSG:3003 come default prudenziale
-        crs = particelle_in_foglio.crs.to_string() if particelle_in_foglio.crs else 'EPSG:3003'
-        uri = f"{QgsWkbTypes.displayString(wkb_type)}?crs={crs}"
+        map_file, ple_file = trova_file_gml(comune_dir)
+        if not map_file or not ple_file:
+            QtWidgets.QMessageBox.critical(self, "Errore",
+                                           "File catastali '_map.gml' o '_ple.gml' non trovati nella cartella.")
+            return
 
-        # Nome layer: Comune + Foglio + elenco particelle realmente caricate
-        particelle_label = ", ".join(sorted(trovate, key=lambda x: (len(x), x))) if trovate else num_particella
-        layer_name = f"{nome_comune} - F. {num_foglio} - P. {particelle_label}"
+        errore = None
+        QtWidgets.QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            panoramica_path = carica_panoramica(comune_dir, limite_memoria_mb=self._limite_memoria_mb())
+        except Exception as e:
+            panoramica_path, errore = None, e
+        finally:
+            QtWidgets.QApplication.restoreOverrideCursor()
 
-        # Crea layer memoria e schema attributi
-        mem_layer = QgsVectorLayer(uri, layer_name, "memory")
-        provider = mem_layer.dataProvider()
-
-        fields = QgsFields()
-        for col_name, dtype in zip(particelle_in_foglio.columns, particelle_in_foglio.dtypes):
-            if col_name == 'geometry':
-                continue
-            dtypestr = str(dtype)
-            if 'int' in dtypestr:
-                fields.append(QgsField(col_name, QVariant.Int))
-            elif 'float' in dtypestr:
-                fields.append(QgsField(col_name, QVariant.Double))
-            else:
-                fields.append(QgsField(col_name, QVariant.String))
-        provider.addAttributes(fields)
-        mem_layer.updateFields()
-
-        # Inserimento feature dal GeoDataFrame
-        features = []
-        for _, row in particelle_in_foglio.iterrows():
-            feat = QgsFeature()
-            feat.setFields(mem_layer.fields())
-            feat.setGeometry(QgsGeometry.fromWkt(row.geometry.wkt))
-            attr_values = [row[col] for col in mem_layer.fields().names()]
-            feat.setAttributes(attr_values)
-            features.append(feat)
-
-        provider.addFeatures(features)
-        mem_layer.updateExtents()
-
-        # Evita duplicati nel progetto: rimuove eventuali layer con lo stesso nome
-        existing = [lyr for lyr in QgsProject.instance().mapLayers().values()
-                    if lyr.name() == mem_layer.name()]
-        for lyr in existing:
-            QgsProject.instance().removeMapLayer(lyr.id())
-
-        # Aggiunge il layer al progetto
-        QgsProject.instance().addMapLayer(mem_layer)
+        if not panoramica_path:
+            dettagli = f"\n\nDettagli: {errore}" if errore else ""
+            QtWidgets.QMessageBox.critical(self, "Errore",
+                                           "Impossibile generare la panoramica del comune." + dettagli)
+            return
 
-        QtWidgets.QMessageBox.information(self, "Successo",
-                                          f"Layer '{mem_layer.name()}' caricato correttamente.")
+        voci = []
+        for tipo, gml_file in (("fogli", map_file), ("particelle", ple_file)):
+            voci.append((gml_file, f"{tipo.capitalize()} (dettaglio)", tipo, 0, SCALA_DETTAGLIO))
+            for tolleranza_m, scala_grande, scala_piccola in LIVELLI_PANORAMICA:
+                voci.append((f"{panoramica_path}|layername={nome_livello(tipo, tolleranza_m)}",
+                             f"{tipo.capitalize()} (semplificati {tolleranza_m:g} m)",
+                             tipo, scala_grande, scala_piccola))
+
+        aggiunti = aggiungi_gruppo_panoramica(f"{nome_comune} - Panoramica", voci)
+        if not aggiunti:
+            QtWidgets.QMessageBox.critical(self, "Errore",
+                                           "Nessun layer della panoramica è stato caricato.")
+
+    def apri_geocodifica_tabella(self):
+        """Apre il dialog di geocodifica in blocco di un layer tabellare."""
+        if self._dialog_tabella is None:
+            self._dialog_tabella = GeocodificaTabellaDialog(BASE_DIR, self._limite_memoria_mb(), self)
+        self._dialog_tabella.limite_memoria_mb = self._limite_memoria_mb()
+        self._dialog_tabella.show()
+        self._dialog_tabella.raise_()
+        self._dialog_tabella.activateWindow()
 
     # ----------------- Download/aggiornamento dati -----------------
 
@@ -471,7 +798,7 @@ class GeocodificaCatastaliDialog(QtWidgets.QDialog, FORM_CLASS):
         """Scarica ed estrae i dati catastali tramite pulsante UI."""
 
         # Disabilita rapidamente la UI per evitare interazioni durante l'operazione
-        for obj in ('scaricaDatiBtn', 'buttonBox', 'provinciaCombo', 'comuneCombo', 'foglioEdit', 'particellaEdit'):
+        for obj in ('scaricaDatiBtn', 'esportaBtn', 'variazioniBtn', 'tabellaBtn', 'panoramicaBtn', 'panoramicheCheck', 'limiteMemoriaSpin', 'buttonBox', 'cercaComuneEdit', 'provinciaCombo', 'comuneCombo', 'foglioEdit', 'particellaEdit'):
             if hasattr(self, obj):
                 getattr(self, obj).setEnabled(False)
 
@@ -484,10 +811,12 @@ class GeocodificaCatastaliDialog(QtWidgets.QDialog, FORM_CLASS):
         if hasattr(self, "lastUpdateLabel"):
             self.lastUpdateLabel.setText("Aggiornamento in corso...")
 
-        ok = scarica_e_scompatta_dataset(dialog_ui=self)
+        panoramiche = hasattr(self, 'panoramicheCheck') and self.panoramicheCheck.isChecked()
+        ok = scarica_e_scompatta_dataset(dialog_ui=self, panoramiche=panoramiche,
+                                         limite_memoria_mb=self._limite_memoria_mb())
 
         # Ripristino della UI
-        for obj in ('scaricaDatiBtn', 'buttonBox', 'provinciaCombo', 'comuneCombo', 'foglioEdit', 'particellaEdit'):
+        for obj in ('scaricaDatiBtn', 'esportaBtn', 'variazioniBtn', 'tabellaBtn', 'panoramicaBtn', 'panoramicheCheck', 'limiteMemoriaSpin', 'buttonBox', 'cercaComuneEdit', 'provinciaCombo', 'comuneCombo', 'foglioEdit', 'particellaEdit'):
             if hasattr(self, obj):
                 getattr(self, obj).setEnabled(True)
 
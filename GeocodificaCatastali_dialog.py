@@ -5,12 +5,15 @@ Dialog del plugin - Geocodifica Catastali
 - Annulla chiude la finestra
 - Il nome del layer include anche il nome del comune
 - Rimozione dei standardButtons e creazione pulsanti custom per evitare qualunque auto-accept
+- Il risultato è un layer in memoria (nessun GPKG temporaneo nella cartella del comune)
 """
 
 import os
 from qgis.PyQt import uic, QtWidgets, QtCore
 import geopandas as gpd
-from qgis.core import QgsVectorLayer, QgsProject
+
+from .layer_catastali import aggiungi_layer_progetto, crea_layer_memoria
+from .lettura_catastale import _friendly_cols, campi_layer, colonna_catastale
 
 # Cartella del plugin e base dati relativa
 PLUGIN_DIR = os.path.dirname(__file__)
@@ -92,7 +95,7 @@ class GeocodificaIndirizzoDialog(QtWidgets.QDialog, FORM_CLASS):
 
     def run_script(self) -> bool:
         """
-        Valida input, legge GML, filtra/interseca e carica il layer.
+        Valida input, legge GML, filtra/interseca e carica il layer in memoria.
         Ritorna True se tutto OK; False altrimenti. La finestra resta aperta.
         """
         # Verifica elementi UI necessari (combinazioni possibili: *Edit o *Combo)
@@ -133,6 +136,22 @@ class GeocodificaIndirizzoDialog(QtWidgets.QDialog, FORM_CLASS):
                                            "File catastali '_map.gml' o '_ple.gml' non trovati nella cartella.")
             return False
 
+        # Colonne FOGLIO/PARTICELLA dallo schema dei GML (cache per rilascio)
+        try:
+            col_foglio = colonna_catastale(map_file, "FOGLIO")
+            col_part = colonna_catastale(ple_file, "PARTICELLA")
+        except Exception as e:
+            QtWidgets.QMessageBox.critical(self, "Errore",
+                                           f"Errore lettura schema dei file GML:\n{e}")
+            return False
+
+        if not col_foglio or not col_part:
+            gml, tipo = (map_file, "FOGLIO") if not col_foglio else (ple_file, "PARTICELLA")
+            QtWidgets.QMessageBox.critical(self, f"Campo {tipo} non trovato",
+                                           f"Impossibile individuare la colonna {tipo} nel file:\n{gml}\n"
+                                           f"Colonne disponibili: {_friendly_cols(campi_layer(gml))}")
+            return False
+
         # Lettura GML
         try:
             gdf_map = gpd.read_file(map_file)
@@ -149,13 +168,13 @@ class GeocodificaIndirizzoDialog(QtWidgets.QDialog, FORM_CLASS):
             return False
 
         # Filtra foglio e particella
-        foglio_sel = gdf_map[gdf_map.get("LABEL", None) == str(foglio)]
+        foglio_sel = gdf_map[gdf_map[col_foglio].astype(str).str.strip() == str(foglio)]
         if foglio_sel is None or foglio_sel.empty:
             QtWidgets.QMessageBox.warning(self, "Foglio non trovato",
                                           f"Foglio '{foglio}' non presente nel file '_map.gml'.")
             return False
 
-        particella_sel = gdf_ple[gdf_ple.get("LABEL", None) == str(particella)]
+        particella_sel = gdf_ple[gdf_ple[col_part].astype(str).str.strip() == str(particella)]
         if particella_sel is None or particella_sel.empty:
             QtWidgets.QMessageBox.warning(self, "Particella non trovata",
                                           f"Particella '{particella}' non presente nel file '_ple.gml'.")
@@ -174,30 +193,21 @@ class GeocodificaIndirizzoDialog(QtWidgets.QDialog, FORM_CLASS):
                                           "La particella selezionata non ricade nel foglio indicato.")
             return False
 
-        # Scrive un GPKG temporaneo nel comune (sovrascrive se presente)
-        temp_path = os.path.join(comune_dir, "particella_sel.gpkg")
-        try:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-        except Exception:
-            pass
-
+        # Crea il layer in memoria (INCLUDE il nome del comune): nessun file
+        # temporaneo nella cartella dati né conflitti tra sessioni QGIS che la condividono
+        layer_name = f"{comune}-F.{foglio}-P.{particella}"
         try:
-            particella_in_foglio.to_file(temp_path, driver="GPKG")
+            layer = crea_layer_memoria(particella_in_foglio, layer_name)
         except Exception as e:
-            QtWidgets.QMessageBox.critical(self, "Errore salvataggio",
-                                           f"Errore nel salvataggio del GeoPackage:\n{temp_path}\n\nDettagli: {e}")
+            QtWidgets.QMessageBox.critical(self, "Errore",
+                                           f"Errore nella creazione del layer:\n{e}")
             return False
-
-        # Carica il layer in QGIS (INCLUDE il nome del comune)
-        layer_name = f"{comune}-F.{foglio}-P.{particella}"
-        layer = QgsVectorLayer(temp_path, layer_name, "ogr")
         if not layer or not layer.isValid():
             QtWidgets.QMessageBox.critical(self, "Errore",
                                            "Errore nel caricamento del layer in QGIS.")
             return False
 
-        QgsProject.instance().addMapLayer(layer)
+        aggiungi_layer_progetto(layer)
         QtWidgets.QMessageBox.information(self, "Successo",
                                           f"Layer '{layer_name}' caricato correttamente.")
         # La finestra resta aperta
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Dialog geocodifica di tabelle - Plugin Geocodifica Catastali
+Geocodifica in blocco di un layer tabellare (es. registro delle pratiche) con
+colonne comune, foglio e particelle: il risultato è un layer con gli attributi
+originali, l'esito di ogni riga e la geometria delle particelle trovate.
+"""
+
+from qgis.PyQt import QtWidgets
+from qgis.gui import QgsMapLayerComboBox, QgsFieldComboBox
+from qgis.core import QgsMapLayerProxyModel
+from PyQt5.QtCore import Qt, QVariant
+import pandas as pd
+import geopandas as gpd
+
+from .lettura_catastale import LIMITE_MEMORIA_MB
+from .indice_comuni import costruisci_indice_comuni
+from .geocodifica_tabella import STATI_RIGA, geocodifica_righe
+from .layer_catastali import aggiungi_layer_progetto, crea_layer_memoria
+
+# Alias per la proposta automatica delle colonne: chiave riga -> alias nomi campo
+# (confronto esatto, senza maiuscole/minuscole: alias brevi come "fg" o "prov"
+# non devono corrispondere a campi come "provvedimento")
+ALIASES_CAMPI_TABELLA = {
+    "comune": ["comune", "cod_comune", "codice_comune", "belfiore"],
+    "provincia": ["provincia", "prov"],
+    "foglio": ["foglio", "fg"],
+    "particelle": ["particelle", "particella", "mappali", "mappale", "part"],
+}
+
+# Prefisso delle colonne di esito aggiunte agli attributi originali
+PREFISSO_ESITO = "GEO_"
+
+
+def _proponi_campo(nomi, aliases):
+    """Primo alias con un campo di nome uguale (senza maiuscole/minuscole), None se nessuno."""
+    per_nome = {}
+    for nome in nomi:
+        per_nome.setdefault(nome.lower(), nome)
+    for alias in aliases:
+        if alias in per_nome:
+            return per_nome[alias]
+    return None
+
+
+def _valore_attributo(valore):
+    """Valore di un attributo QGIS convertito in tipo Python semplice (None per NULL)."""
+    if valore is None or (isinstance(valore, QVariant) and valore.isNull()):
+        return None
+    if isinstance(valore, (bool, int, float, str)):
+        return valore
+    return str(valore)
+
+
+class GeocodificaTabellaDialog(QtWidgets.QDialog):
+    def __init__(self, base_dir, limite_memoria_mb=LIMITE_MEMORIA_MB, parent=None):
+        super(GeocodificaTabellaDialog, self).__init__(parent)
+        self.base_dir = base_dir
+        self.limite_memoria_mb = limite_memoria_mb
+        self.setWindowTitle("Geocodifica tabella")
+
+        # Layer e mappatura delle colonne
+        self.layerCombo = QgsMapLayerComboBox(self)
+        self.layerCombo.setFilters(QgsMapLayerProxyModel.VectorLayer)
+
+        self.campiCombo = {}
+        form = QtWidgets.QFormLayout()
+        form.addRow("Tabella:", self.layerCombo)
+        for chiave, etichetta in (("comune", "Comune:"), ("provincia", "Provincia:"),
+                                  ("foglio", "Foglio:"), ("particelle", "Particelle:")):
+            combo = QgsFieldComboBox(self)
+            # Provincia facoltativa: serve solo per i nomi presenti in più province
+            combo.setAllowEmptyFieldName(chiave == "provincia")
+            self.campiCombo[chiave] = combo
+            form.addRow(etichetta, combo)
+
+        self.soloSelezionateCheck = QtWidgets.QCheckBox("Solo righe selezionate", self)
+
+        self.progressBar = QtWidgets.QProgressBar(self)
+        self.progressBar.setTextVisible(True)
+        self.progressBar.hide()
+
+        self.buttonBox = QtWidgets.QDialogButtonBox(self)
+        self.geocodificaBtn = self.buttonBox.addButton("Geocodifica", QtWidgets.QDialogButtonBox.ActionRole)
+        self.buttonBox.addButton("Chiudi", QtWidgets.QDialogButtonBox.RejectRole)
+        self.geocodificaBtn.clicked.connect(self.geocodifica)
+        self.buttonBox.rejected.connect(self.reject)
+
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addLayout(form)
+        layout.addWidget(self.soloSelezionateCheck)
+        layout.addWidget(self.progressBar)
+        layout.addWidget(self.buttonBox)
+
+        self.layerCombo.layerChanged.connect(self.on_layer_changed)
+        self.on_layer_changed(self.layerCombo.currentLayer())
+
+    def on_layer_changed(self, layer):
+        """Aggiorna i campi disponibili e propone la mappatura dai nomi delle colonne."""
+        nomi = layer.fields().names() if layer is not None else []
+        for chiave, combo in self.campiCombo.items():
+            combo.setLayer(layer)
+            colonna = _proponi_campo(nomi, ALIASES_CAMPI_TABELLA[chiave])
+            combo.setField(colonna or "")
+        self.soloSelezionateCheck.setChecked(layer is not None and layer.selectedFeatureCount() > 0)
+
+    def geocodifica(self):
+        """Legge le righe della tabella, le geocodifica per comune e carica il layer risultato."""
+        layer = self.layerCombo.currentLayer()
+        campi = {chiave: combo.currentField() for chiave, combo in self.campiCombo.items()}
+        if layer is None or not all(campi[c] for c in ("comune", "foglio", "particelle")):
+            QtWidgets.QMessageBox.warning(self, "Input Mancante",
+                                          "Selezionare la tabella e le colonne di comune, foglio e particelle.")
+            return
+
+        solo_selezionate = self.soloSelezionateCheck.isChecked()
+        features = layer.getSelectedFeatures() if solo_selezionate else layer.getFeatures()
+        nomi = layer.fields().names()
+        attributi = [[_valore_attributo(v) for v in f.attributes()] for f in features]
+        if not attributi:
+            QtWidgets.QMessageBox.warning(self, "Tabella vuota", "Nessuna riga da geocodificare.")
+            return
+
+        posizioni = {chiave: nomi.index(campo) for chiave, campo in campi.items() if campo}
+        righe = [{chiave: valori[pos] for chiave, pos in posizioni.items()} for valori in attributi]
+
+        def avanzamento(elaborati, totale, nome_comune):
+            self.progressBar.setValue(int(elaborati * 100 / totale))
+            self.progressBar.setFormat(f"{nome_comune} ({elaborati}/{totale})")
+            QtWidgets.QApplication.processEvents()
+
+        self.geocodificaBtn.setEnabled(False)
+        self.progressBar.setValue(0)
+        self.progressBar.show()
+        QtWidgets.QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            voci_comuni = costruisci_indice_comuni(self.base_dir)
+            esiti, statistiche = geocodifica_righe(righe, voci_comuni, self.base_dir,
+                                                   self.limite_memoria_mb, avanzamento)
+        except Exception as e:
+            QtWidgets.QMessageBox.critical(self, "Errore", f"Errore durante la geocodifica:\n{e}")
+            return
+        finally:
+            QtWidgets.QApplication.restoreOverrideCursor()
+            self.progressBar.hide()
+            self.geocodificaBtn.setEnabled(True)
+
+        # Attributi originali + esito di ogni riga, con la geometria delle particelle trovate
+        colonne_esito = esiti.drop(columns="geometry").add_prefix(PREFISSO_ESITO)
+        risultato = gpd.GeoDataFrame(
+            pd.concat([pd.DataFrame(attributi, columns=nomi), colonne_esito], axis=1),
+            geometry=esiti.geometry.values,
+            crs=esiti.crs,
+        )
+        try:
+            layer_risultato = crea_layer_memoria(risultato, f"{layer.name()} - Geocodifica")
+        except Exception as e:
+            QtWidgets.QMessageBox.critical(self, "Errore", f"Errore nella creazione del layer:\n{e}")
+            return
+        aggiungi_layer_progetto(layer_risultato)
+
+        QtWidgets.QMessageBox.information(
+            self, "Geocodifica completata",
+            f"Layer '{layer_risultato.name()}' caricato.\n"
+            f"{statistiche['righe']} righe in {statistiche['comuni']} comuni, "
+            f"{statistiche['secondi']} s ({statistiche['righe_al_secondo']} righe/s).\n"
+            + ", ".join(f"{statistiche[stato]} {stato}" for stato in STATI_RIGA)
+        )
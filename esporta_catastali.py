@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo esportazione in streaming - Plugin Geocodifica Catastali
+Copia le particelle di un foglio o di un intero comune dal GML sorgente
+direttamente in un GeoPackage o Shapefile, a blocchi di feature, senza
+passare da GeoDataFrame o layer in memoria: l'occupazione di memoria resta
+limitata qualunque sia la dimensione del comune.
+"""
+
+from qgis.core import (
+    QgsVectorLayer,
+    QgsProject,
+    QgsFeatureRequest,
+    QgsGeometry,
+    QgsVectorFileWriter,
+)
+
+from .lettura_catastale import _friendly_cols, colonna_catastale
+
+# Numero di feature scritte per blocco
+DIMENSIONE_BLOCCO = 1000
+
+# Driver OGR per estensione del file di destinazione
+DRIVER_PER_ESTENSIONE = {
+    ".gpkg": "GPKG",
+    ".shp": "ESRI Shapefile",
+}
+
+
+def geometria_foglio(map_file, foglio):
+    """
+    Ritorna la geometria (unione delle eventuali parti) del foglio indicato,
+    letta dal file _map.gml con filtro sull'attributo. None se non trovato.
+    """
+    layer_map = QgsVectorLayer(map_file, "fogli", "ogr")
+    if not layer_map.isValid():
+        raise RuntimeError(f"Impossibile aprire il file:\n{map_file}")
+
+    col_foglio = colonna_catastale(map_file, "FOGLIO")
+    if not col_foglio:
+        raise RuntimeError("Impossibile individuare la colonna del FOGLIO nel file _map.gml.\n"
+                           f"Colonne disponibili: {_friendly_cols(layer_map.fields().names())}")
+
+    valore = str(foglio).strip().replace("'", "''")
+    request = QgsFeatureRequest().setFilterExpression(f"trim(to_string(\"{col_foglio}\")) = '{valore}'")
+    geometrie = [f.geometry() for f in layer_map.getFeatures(request) if f.hasGeometry()]
+    if not geometrie:
+        return None
+    return geometrie[0] if len(geometrie) == 1 else QgsGeometry.unaryUnion(geometrie)
+
+
+def esporta_particelle(ple_file, dest_path, driver="GPKG", geometria_filtro=None,
+                       totale_previsto=None, dimensione_blocco=DIMENSIONE_BLOCCO, progress_cb=None):
+    """
+    Esporta in streaming le particelle di ple_file in dest_path.
+    Se geometria_filtro è indicata (es. il foglio), sono esportate solo le
+    particelle il cui punto interno ricade nella geometria (stessa regola
+    dell'indice fogli/particelle).
+    progress_cb(scritte, totale) è chiamata dopo ogni blocco; totale può essere
+    None se non noto. Ritorna il numero di particelle esportate.
+    """
+    sorgente = QgsVectorLayer(ple_file, "particelle", "ogr")
+    if not sorgente.isValid():
+        raise RuntimeError(f"Impossibile aprire il file:\n{ple_file}")
+
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = driver
+    options.fileEncoding = "UTF-8"
+    writer = QgsVectorFileWriter.create(dest_path, sorgente.fields(), sorgente.wkbType(), sorgente.crs(),
+                                        QgsProject.instance().transformContext(), options)
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        messaggio = writer.errorMessage()
+        del writer
+        raise RuntimeError(f"Impossibile creare il file:\n{dest_path}\n\nDettagli: {messaggio}")
+
+    request = QgsFeatureRequest()
+    engine = None
+    if geometria_filtro is not None:
+        # Pre-filtro per bounding box lato OGR, poi test esatto su geometria preparata
+        request.setFilterRect(geometria_filtro.boundingBox())
+        engine = QgsGeometry.createGeometryEngine(geometria_filtro.constGet())
+        engine.prepareGeometry()
+    elif totale_previsto is None:
+        totale_previsto = sorgente.featureCount() if sorgente.featureCount() >= 0 else None
+
+    scritte = 0
+    blocco = []
+    try:
+        for feat in sorgente.getFeatures(request):
+            if engine is not None:
+                if not feat.hasGeometry():
+                    continue
+                punto = feat.geometry().pointOnSurface()
+                if punto.isNull() or not engine.intersects(punto.constGet()):
+                    continue
+
+            blocco.append(feat)
+            if len(blocco) >= dimensione_blocco:
+                if not writer.addFeatures(blocco):
+                    raise RuntimeError(f"Errore di scrittura:\n{writer.errorMessage()}")
+                scritte += len(blocco)
+                blocco = []
+                if progress_cb:
+                    progress_cb(scritte, totale_previsto)
+
+        if blocco:
+            if not writer.addFeatures(blocco):
+                raise RuntimeError(f"Errore di scrittura:\n{writer.errorMessage()}")
+            scritte += len(blocco)
+            if progress_cb:
+                progress_cb(scritte, totale_previsto)
+    finally:
+        # La distruzione del writer chiude e finalizza il file
+        del writer
+
+    return scritte
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo geocodifica di tabelle - Plugin Geocodifica Catastali
+Geocodifica in blocco di un elenco di righe (comune, foglio, particelle),
+ad esempio il registro delle pratiche: le righe sono raggruppate per comune
+e ogni comune è letto e risolto una sola volta per tutte le sue righe
+(senza dipendenze da QGIS).
+"""
+
+import os
+import re
+import time
+
+import geopandas as gpd
+
+from .lettura_catastale import LIMITE_MEMORIA_MB
+from .ricerca_catastale import ErroreRicerca, carica_dati_comune
+from .indice_catastale import _assegna_fogli
+from .indice_comuni import indice_nomi_comuni, trova_comune
+from .geometrie_catastali import unisci_geometrie
+
+# Esito di ogni riga
+STATI_RIGA = ("trovata", "parziale", "non trovata", "comune non trovato", "errore")
+
+
+def dividi_particelle(testo):
+    """
+    Elenco delle particelle di una cella (separate da virgola o punto e virgola).
+    Un valore numerico (es. 5.0 da un campo Real) è una sola particella.
+    """
+    if testo is None:
+        return []
+    if not isinstance(testo, str):
+        testo = _etichetta(testo)
+    return [p.strip() for p in re.split(r"[,;]", testo) if p.strip()]
+
+
+def _etichetta(valore):
+    """Etichetta normalizzata di foglio/particella (es. 12.0 letto da un campo numerico -> "12")."""
+    if valore is None:
+        return ""
+    if isinstance(valore, float) and valore.is_integer():
+        valore = int(valore)
+    return str(valore).strip()
+
+
+def _esito(stato, trovate=(), mancanti=(), geometria=None, comune="", messaggio=""):
+    return {
+        "STATO": stato,
+        "COMUNE_CATASTALE": comune,
+        "N_TROVATE": len(trovate),
+        "TROVATE": ", ".join(trovate),
+        "MANCANTI": ", ".join(mancanti),
+        "MESSAGGIO": messaggio,
+        "geometry": geometria,
+    }
+
+
+def _geometrie_comune(comune_dir, richieste, limite_memoria_mb):
+    """
+    Lettura unica del comune: particelle richieste (tutte le righe insieme)
+    assegnate al foglio che contiene il punto interno, come nell'indice.
+    Ritorna {(foglio, particella): [geometrie]} e il CRS.
+    """
+    fogli, particelle = carica_dati_comune(comune_dir, richieste, limite_memoria_mb)
+    punti = gpd.GeoDataFrame({"PARTICELLA": particelle["PARTICELLA"]},
+                             geometry=particelle.geometry.representative_point(), crs=particelle.crs)
+    assegnate = _assegna_fogli(punti, fogli)
+
+    geometrie = {}
+    valori = particelle.geometry.loc[assegnate.index].values
+    for foglio, particella, geometria in zip(assegnate["FOGLIO"], assegnate["PARTICELLA"], valori):
+        geometrie.setdefault((foglio, particella), []).append(geometria)
+    return geometrie, particelle.crs
+
+
+def geocodifica_righe(righe, voci_comuni, base_dir, limite_memoria_mb=LIMITE_MEMORIA_MB, progress_cb=None):
+    """
+    Geocodifica le righe: ogni riga è un dict con comune, foglio, particelle
+    (testo separato da virgole) e, facoltativa, provincia. I comuni sono
+    risolti con l'indice dei comuni (codice catastale o nome).
+    Ritorna (esiti, statistiche): esiti è un GeoDataFrame allineato alle righe
+    con STATO, COMUNE_CATASTALE, N_TROVATE, TROVATE, MANCANTI, MESSAGGIO e
+    l'unione delle particelle trovate come geometria; statistiche riporta
+    righe, comuni, tempo e righe al secondo.
+    progress_cb(comuni_elaborati, totale_comuni, nome_comune) dopo ogni comune.
+    """
+    inizio = time.perf_counter()
+    esiti = [None] * len(righe)
+
+    # Raggruppamento delle righe per cartella del comune: ogni coppia distinta
+    # (comune, provincia) è risolta una sola volta sull'indice dei nomi
+    indice_nomi = indice_nomi_comuni(voci_comuni)
+    risolti = {}
+    per_comune = {}
+    for i, riga in enumerate(righe):
+        comune = _etichetta(riga.get("comune"))
+        chiave = (comune, _etichetta(riga.get("provincia")))
+        if chiave not in risolti:
+            risolti[chiave] = trova_comune(indice_nomi, *chiave)
+        candidati = risolti[chiave]
+        if len(candidati) != 1:
+            messaggio = (f"Comune '{comune}' presente in più province: indicare la provincia." if candidati
+                         else f"Comune '{comune}' non trovato.")
+            esiti[i] = _esito("comune non trovato", messaggio=messaggio)
+            continue
+        voce = candidati[0]
+        comune_dir = os.path.join(base_dir, voce["provincia"], voce["cartella"])
+        per_comune.setdefault(comune_dir, []).append(i)
+
+    crs_risultato = None
+    for n, (comune_dir, indici) in enumerate(per_comune.items(), start=1):
+        nome_comune = os.path.basename(comune_dir)
+        richieste = {p for i in indici for p in dividi_particelle(righe[i].get("particelle"))}
+        try:
+            geometrie, crs = _geometrie_comune(comune_dir, richieste, limite_memoria_mb)
+        except Exception as e:
+            messaggio = e.messaggio if isinstance(e, ErroreRicerca) else str(e)
+            for i in indici:
+                esiti[i] = _esito("errore", comune=nome_comune, messaggio=messaggio)
+            geometrie = None
+
+        if geometrie is not None:
+            if crs_risultato is None:
+                crs_risultato = crs
+            for i in indici:
+                foglio = _etichetta(righe[i].get("foglio"))
+                particelle = dividi_particelle(righe[i].get("particelle"))
+                if not foglio or not particelle:
+                    esiti[i] = _esito("errore", comune=nome_comune, messaggio="Foglio o particelle mancanti.")
+                    continue
+                trovate = [p for p in particelle if (foglio, p) in geometrie]
+                mancanti = [p for p in particelle if (foglio, p) not in geometrie]
+                if not trovate:
+                    esiti[i] = _esito("non trovata", mancanti=mancanti, comune=nome_comune)
+                    continue
+                parti = gpd.GeoSeries([g for p in trovate for g in geometrie[(foglio, p)]], crs=crs)
+                if crs_risultato is not None and crs is not None and crs != crs_risultato:
+                    parti = parti.to_crs(crs_risultato)
+                esiti[i] = _esito("parziale" if mancanti else "trovata", trovate, mancanti,
+                                  unisci_geometrie(parti), nome_comune)
+
+        if progress_cb:
+            progress_cb(n, len(per_comune), nome_comune)
+
+    risultato = gpd.GeoDataFrame(esiti, geometry="geometry", crs=crs_risultato)
+    durata = time.perf_counter() - inizio
+    statistiche = {
+        "righe": len(righe),
+        "comuni": len(per_comune),
+        "secondi": round(durata, 2),
+        "righe_al_secondo": round(len(righe) / durata, 1) if durata > 0 else 0.0,
+        **{stato: int((risultato["STATO"] == stato).sum()) for stato in STATI_RIGA},
+    }
+    return risultato, statistiche
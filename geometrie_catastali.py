@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo elaborazioni geometriche - Plugin Geocodifica Catastali
+Unione (dissolve) delle particelle selezionate e misure di superficie/perimetro,
+in forma vettoriale sull'intera selezione, e panoramiche semplificate a più
+livelli di dettaglio per la visualizzazione dell'intero comune
+(senza dipendenze da QGIS).
+"""
+
+import os
+import geopandas as gpd
+
+try:
+    from shapely import coverage_union_all, union_all
+except ImportError:  # shapely < 2.0
+    coverage_union_all = None
+    from shapely.ops import unary_union as union_all
+
+from .lettura_catastale import chiave_etichetta, scrittura_atomica
+
+# CRS metrico per le misure se i dati sono in coordinate geografiche (RDN2008 / UTM 32N)
+CRS_METRICO = "EPSG:6707"
+
+# Scarto relativo ammesso tra somma delle aree e area dell'unione "a copertura"
+TOLLERANZA_COPERTURA = 1e-6
+
+
+def _geometrie_metriche(gdf):
+    """Geometrie in un CRS metrico (riproiettate solo se il CRS è geografico)."""
+    if gdf.crs is not None and gdf.crs.is_geographic:
+        return gdf.geometry.to_crs(CRS_METRICO)
+    return gdf.geometry
+
+
+def aggiungi_misure(gdf):
+    """Aggiunge le colonne AREA_MQ e PERIMETRO_M, calcolate su tutte le righe in un'unica passata."""
+    geometrie = _geometrie_metriche(gdf)
+    gdf = gdf.copy()
+    gdf["AREA_MQ"] = geometrie.area.round(2).to_numpy()
+    gdf["PERIMETRO_M"] = geometrie.length.round(2).to_numpy()
+    return gdf
+
+
+def unisci_geometrie(geometrie):
+    """
+    Unione delle geometrie. Le particelle catastali formano di norma una
+    copertura (nessuna sovrapposizione): si usa prima coverage_union_all, molto
+    più rapida; se il risultato non è valido o l'area non torna (sovrapposizioni)
+    si ripiega sull'unione generica union_all.
+    """
+    valori = geometrie.values
+    if coverage_union_all is not None:
+        try:
+            unione = coverage_union_all(valori)
+            somma_aree = float(geometrie.area.sum())
+            if unione.is_valid and abs(unione.area - somma_aree) <= TOLLERANZA_COPERTURA * max(somma_aree, 1.0):
+                return unione
+        except Exception:
+            pass
+    return union_all(valori)
+
+
+def dissolvi_particelle(gdf):
+    """
+    Ritorna un GeoDataFrame di una riga con il perimetro esterno delle particelle
+    selezionate: FOGLIO e PARTICELLA riportano gli elenchi (ordinati) dei valori
+    uniti, N_PARTICELLE il numero di coppie foglio/particella distinte, più
+    superficie e perimetro dell'unione.
+    """
+    geometrie = gdf.geometry[gdf.geometry.notna() & ~gdf.geometry.is_empty]
+    unione = unisci_geometrie(geometrie)
+
+    def elenco(colonna):
+        if colonna not in gdf.columns:
+            return ""
+        valori = set(gdf[colonna].astype(str).str.strip())
+        return ", ".join(sorted(valori, key=chiave_etichetta))
+
+    # Particelle distinte: parti multiple o frammenti della stessa particella contano una volta
+    chiavi = [c for c in ("FOGLIO", "PARTICELLA") if c in gdf.columns]
+    if chiavi:
+        n_particelle = len(gdf[chiavi].astype(str).apply(lambda colonna: colonna.str.strip()).drop_duplicates())
+    else:
+        n_particelle = len(gdf)
+
+    risultato = gpd.GeoDataFrame(
+        {
+            "FOGLIO": [elenco("FOGLIO")],
+            "PARTICELLA": [elenco("PARTICELLA")],
+            "N_PARTICELLE": [n_particelle],
+        },
+        geometry=[unione],
+        crs=gdf.crs,
+    )
+    return aggiungi_misure(risultato)
+
+
+# ----------------- Panoramiche semplificate -----------------
+
+# File delle panoramiche nella cartella del comune (un layer per livello)
+NOME_PANORAMICA = "panoramica.gpkg"
+
+# Dettaglio completo (GML originali) visibile fino a questa scala (1:N)
+SCALA_DETTAGLIO = 5000
+
+# Livelli: (tolleranza in metri, scala 1:N più grande, scala 1:N più piccola; 0 = nessun limite)
+LIVELLI_PANORAMICA = (
+    (1.0, SCALA_DETTAGLIO, 25000),
+    (5.0, 25000, 100000),
+    (20.0, 100000, 0),
+)
+
+
+def semplifica_copertura(geometrie, tolleranza_m):
+    """
+    Semplifica le geometrie conservando la topologia della copertura: con
+    coverage_simplify (shapely >= 2.1) i confini condivisi restano coincidenti
+    e non si creano buchi o sovrapposizioni tra particelle adiacenti.
+    coverage_simplify è definita solo per coperture valide: se le geometrie si
+    sovrappongono (allegati, sviluppi, scarti di digitalizzazione) o shapely è
+    meno recente, si semplifica ogni geometria con preserve_topology.
+    """
+    tolleranza = tolleranza_m
+    if geometrie.crs is not None and geometrie.crs.is_geographic:
+        tolleranza = tolleranza_m / 111320.0  # metri -> gradi (approssimato)
+    try:
+        from shapely import coverage_is_valid, coverage_simplify
+    except ImportError:
+        return geometrie.simplify(tolleranza, preserve_topology=True)
+    if not coverage_is_valid(geometrie.values):
+        return geometrie.simplify(tolleranza, preserve_topology=True)
+    return gpd.GeoSeries(coverage_simplify(geometrie.values, tolleranza),
+                         index=geometrie.index, crs=geometrie.crs)
+
+
+def nome_livello(tipo, tolleranza_m):
+    """Nome del layer nel GeoPackage delle panoramiche (es. particelle_5m)."""
+    return f"{tipo}_{tolleranza_m:g}m"
+
+
+def salva_panoramica(path, fogli, particelle):
+    """
+    Scrive in path (GeoPackage) le versioni semplificate di fogli e particelle
+    per ogni livello di LIVELLI_PANORAMICA (fogli con colonna FOGLIO, particelle
+    con FOGLIO e PARTICELLA, più geometry). Ritorna i nomi dei layer scritti.
+    """
+    layer_scritti = []
+
+    def scrivi(tmp_path):
+        os.remove(tmp_path)  # il GeoPackage è creato dal driver, non su un file vuoto
+        for tipo, gdf in (("fogli", fogli), ("particelle", particelle)):
+            gdf = gdf[gdf.geometry.notna() & ~gdf.geometry.is_empty]
+            for tolleranza_m, _, _ in LIVELLI_PANORAMICA:
+                semplificato = gdf.copy()
+                semplificato["geometry"] = semplifica_copertura(gdf.geometry, tolleranza_m)
+                nome = nome_livello(tipo, tolleranza_m)
+                semplificato.to_file(tmp_path, layer=nome, driver="GPKG")
+                layer_scritti.append(nome)
+
+    scrittura_atomica(path, scrivi)
+    return layer_scritti
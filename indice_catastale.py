@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo indice fogli/particelle - Plugin Geocodifica Catastali
+Per ogni comune salva un file JSON leggero con l'elenco ordinato dei fogli e,
+per ciascun foglio, delle particelle che vi ricadono. L'indice viene calcolato
+una sola volta (in fase di scaricamento o al primo utilizzo) ed evita di
+rileggere i GML per l'autocompletamento dei campi.
+Nella stessa fase si calcola il grafo delle particelle confinanti (formato
+CSR compatto in .npz, con le geometrie in un GeoPackage letto per posizione)
+per le ricerche "particella + N anelli di confinanti"
+e si aggiornano le impronte per il confronto tra rilasci (variazioni_catastali).
+Su richiesta si generano anche le panoramiche semplificate del comune
+(geometrie_catastali) per la visualizzazione a più livelli di dettaglio.
+"""
+
+import os
+import json
+from collections import deque
+
+import numpy as np
+import geopandas as gpd
+
+from .lettura_catastale import (
+    LIMITE_MEMORIA_MB,
+    azzera_schema_colonne,
+    chiave_etichetta,
+    colonna_catastale,
+    leggi_gml_filtrato,
+    scrittura_atomica,
+    trova_file_gml,
+)
+from .geometrie_catastali import NOME_PANORAMICA, salva_panoramica
+from .variazioni_catastali import aggiorna_impronte, salva_riepilogo_variazioni
+
+# Nome del file indice nella cartella del comune e versione del formato
+NOME_INDICE = "indice_catastale.json"
+VERSIONE_INDICE = 1
+
+# Grafo delle confinanti: nome file e tolleranza (metri) per piccoli scostamenti tra confini
+NOME_GRAFO = "grafo_confinanti.npz"
+TOLLERANZA_CONFINI_M = 0.2
+
+# Geometrie delle particelle salvate insieme al grafo (GeoPackage, FID = posizione + 1):
+# le confinanti trovate sul grafo si leggono per chiave primaria senza rileggere il GML
+NOME_GEOMETRIE = "geometrie_particelle.gpkg"
+
+# Cache in memoria: cartella comune -> (mtime file indice, indice)
+_cache_indici = {}
+
+# Cache in memoria: cartella comune -> (mtime file grafo, grafo)
+_cache_grafi = {}
+
+
+def _firma_sorgenti(map_file, ple_file):
+    """Dimensione e data di modifica dei GML: se cambiano l'indice va ricalcolato."""
+    return [[os.path.getsize(f), int(os.path.getmtime(f))] for f in (map_file, ple_file)]
+
+
+def _leggi_fogli(map_file):
+    """Fogli del comune (colonne FOGLIO normalizzata e geometry), None se colonna assente."""
+    col_foglio = colonna_catastale(map_file, "FOGLIO")
+    if not col_foglio:
+        return None
+    gdf_map = gpd.read_file(map_file)
+    fogli = gdf_map[[col_foglio, "geometry"]].rename(columns={col_foglio: "FOGLIO"})
+    fogli["FOGLIO"] = fogli["FOGLIO"].astype(str).str.strip()
+    return fogli
+
+
+def _assegna_fogli(punti, fogli):
+    """Join spaziale punti interni -> fogli (le righe fuori da ogni foglio sono scartate)."""
+    if fogli.crs is not None and punti.crs is not None and fogli.crs != punti.crs:
+        punti = punti.to_crs(fogli.crs)
+    assegnate = gpd.sjoin(punti, fogli, how="inner", predicate="within")
+    # Un punto su un confine comune a due fogli: vale il primo
+    return assegnate[~assegnate.index.duplicated(keep="first")]
+
+
+def costruisci_indice(comune_dir, limite_memoria_mb=LIMITE_MEMORIA_MB, letti=None):
+    """
+    Legge i GML del comune e salva l'indice fogli -> particelle.
+    Una particella è assegnata al foglio che contiene il suo punto interno
+    (representative_point), con join spaziale su indice R-tree.
+    letti è l'eventuale risultato già disponibile di leggi_particelle_con_fogli.
+    Ritorna l'indice (dict) oppure None se i GML non sono presenti.
+    """
+    map_file, ple_file = trova_file_gml(comune_dir)
+    if not map_file or not ple_file:
+        return None
+
+    fogli = _leggi_fogli(map_file)
+    if fogli is None:
+        return None
+
+    if letti is not None:
+        # Particelle già lette e assegnate ai fogli (fase di scaricamento)
+        particelle_lette, _ = letti
+        assegnate = particelle_lette.loc[particelle_lette["FOGLIO"] != "", ["FOGLIO", "PARTICELLA"]]
+    else:
+        col_part = colonna_catastale(ple_file, "PARTICELLA")
+        if not col_part:
+            return None
+
+        # Delle particelle servono solo etichetta e punto interno: con i GML
+        # più grandi la riduzione avviene blocco per blocco durante la lettura
+        def riduci_a_punti(blocco):
+            return gpd.GeoDataFrame(
+                {"PARTICELLA": blocco[col_part].astype(str).str.strip()},
+                geometry=blocco.geometry.representative_point(),
+                crs=blocco.crs,
+            )
+
+        punti = leggi_gml_filtrato(ple_file, riduci_a_punti, limite_memoria_mb)
+        assegnate = _assegna_fogli(punti, fogli)
+
+    particelle = {
+        foglio: sorted(set(gruppo), key=chiave_etichetta)
+        for foglio, gruppo in assegnate.groupby("FOGLIO")["PARTICELLA"]
+    }
+    indice = {
+        "versione": VERSIONE_INDICE,
+        "sorgenti": _firma_sorgenti(map_file, ple_file),
+        "fogli": sorted(set(fogli["FOGLIO"]), key=chiave_etichetta),
+        "particelle": particelle,
+    }
+
+    # Scrittura atomica: temporaneo univoco + rename
+    def scrivi(tmp_path):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(indice, f, ensure_ascii=False, separators=(",", ":"))
+
+    scrittura_atomica(os.path.join(comune_dir, NOME_INDICE), scrivi)
+
+    _cache_indici.pop(comune_dir, None)
+    return indice
+
+
+def carica_indice(comune_dir, costruisci_se_mancante=True, limite_memoria_mb=LIMITE_MEMORIA_MB):
+    """
+    Ritorna l'indice del comune, dalla cache in memoria o dal file JSON.
+    Se il file manca o non corrisponde ai GML presenti, lo ricalcola
+    (solo se costruisci_se_mancante=True, altrimenti ritorna None).
+    """
+    indice_path = os.path.join(comune_dir, NOME_INDICE)
+    try:
+        mtime = os.path.getmtime(indice_path)
+    except OSError:
+        mtime = None
+
+    cached = _cache_indici.get(comune_dir)
+    if cached and mtime is not None and cached[0] == mtime:
+        return cached[1]
+
+    indice = None
+    if mtime is not None:
+        try:
+            with open(indice_path, "r", encoding="utf-8") as f:
+                indice = json.load(f)
+            map_file, ple_file = trova_file_gml(comune_dir)
+            if (indice.get("versione") != VERSIONE_INDICE or not map_file or not ple_file
+                    or indice.get("sorgenti") != _firma_sorgenti(map_file, ple_file)):
+                indice = None
+        except Exception:
+            indice = None
+
+    if indice is None:
+        if not costruisci_se_mancante:
+            return None
+        indice = costruisci_indice(comune_dir, limite_memoria_mb)
+        if indice is None:
+            return None
+        mtime = os.path.getmtime(indice_path)
+
+    _cache_indici[comune_dir] = (mtime, indice)
+    return indice
+
+
+def fogli_comune(comune_dir, limite_memoria_mb=LIMITE_MEMORIA_MB):
+    """Elenco ordinato dei fogli del comune (vuoto se l'indice non è disponibile)."""
+    indice = carica_indice(comune_dir, limite_memoria_mb=limite_memoria_mb)
+    return list(indice["fogli"]) if indice else []
+
+
+def particelle_foglio(comune_dir, foglio, limite_memoria_mb=LIMITE_MEMORIA_MB):
+    """Elenco ordinato delle particelle del foglio indicato (vuoto se sconosciuto)."""
+    indice = carica_indice(comune_dir, limite_memoria_mb=limite_memoria_mb)
+    if not indice:
+        return []
+    return list(indice["particelle"].get(str(foglio).strip(), []))
+
+
+# ----------------- Grafo delle particelle confinanti -----------------
+
+def leggi_particelle_con_fogli(comune_dir, limite_memoria_mb=LIMITE_MEMORIA_MB):
+    """
+    Legge tutte le particelle del comune (ordine e indice = posizione nel
+    _ple.gml) con le colonne FOGLIO (foglio che contiene il punto interno, ""
+    se nessuno), PARTICELLA e geometry. Ritorna (particelle, firma dei GML)
+    oppure None se i GML o le colonne non sono disponibili.
+    Lettura unica condivisa dalle elaborazioni fatte in fase di scaricamento.
+    La memoria di questa fase non è limitata: grafo (R-tree) e panoramiche
+    richiedono tutte le geometrie insieme, quindi il risultato cresce con il
+    comune in entrambe le modalità. Sopra limite_memoria_mb la lettura a
+    blocchi evita solo di tenere insieme gli altri attributi del GML.
+    """
+    map_file, ple_file = trova_file_gml(comune_dir)
+    if not map_file or not ple_file:
+        return None
+    fogli = _leggi_fogli(map_file)
+    if fogli is None:
+        return None
+
+    col_part = colonna_catastale(ple_file, "PARTICELLA")
+    if not col_part:
+        return None
+
+    def riduci(blocco):
+        return gpd.GeoDataFrame({"PARTICELLA": blocco[col_part].astype(str).str.strip()},
+                                geometry=blocco.geometry, crs=blocco.crs)
+
+    particelle = leggi_gml_filtrato(ple_file, riduci, limite_memoria_mb)
+
+    etichette_fogli = np.full(len(particelle), "", dtype=object)
+    punti = gpd.GeoDataFrame(geometry=particelle.geometry.representative_point(), crs=particelle.crs)
+    assegnate = _assegna_fogli(punti, fogli)
+    etichette_fogli[assegnate.index.to_numpy()] = assegnate["FOGLIO"].to_numpy()
+    particelle.insert(0, "FOGLIO", etichette_fogli.astype(str))
+    return particelle, _firma_sorgenti(map_file, ple_file)
+
+
+def costruisci_grafo_confinanti(comune_dir, limite_memoria_mb=LIMITE_MEMORIA_MB, letti=None):
+    """
+    Calcola e salva il grafo di adiacenza delle particelle del comune.
+    I nodi sono le particelle nell'ordine del file _ple.gml (nodo = posizione
+    della feature), con etichette foglio/particella; gli archi collegano le
+    particelle a distanza inferiore alla tolleranza, trovate con un'unica
+    interrogazione vettoriale dell'indice R-tree. Il grafo è salvato in forma
+    CSR (indptr/indices int32), con le geometrie dei nodi in NOME_GEOMETRIE.
+    letti è l'eventuale risultato già disponibile di leggi_particelle_con_fogli.
+    Ritorna il grafo oppure None.
+    """
+    if letti is None:
+        letti = leggi_particelle_con_fogli(comune_dir, limite_memoria_mb)
+    if letti is None:
+        return None
+    particelle, firma = letti
+    n = len(particelle)
+
+    # Coppie (i, j) di particelle confinanti, in un'unica query bulk sull'R-tree
+    geometrie = particelle.geometry.reset_index(drop=True)
+    tolleranza = TOLLERANZA_CONFINI_M
+    if geometrie.crs is not None and geometrie.crs.is_geographic:
+        tolleranza = TOLLERANZA_CONFINI_M / 111320.0  # metri -> gradi (approssimato)
+    try:
+        origini, vicini = geometrie.sindex.query(geometrie, predicate="dwithin", distance=tolleranza)
+    except (TypeError, ValueError, NotImplementedError):
+        # GEOS/geopandas senza "dwithin": stesso risultato con buffer + intersects
+        origini, vicini = geometrie.sindex.query(geometrie.buffer(tolleranza), predicate="intersects")
+
+    diverse = origini != vicini
+    origini, vicini = origini[diverse], vicini[diverse]
+    ordine = np.lexsort((vicini, origini))
+    origini, vicini = origini[ordine], vicini[ordine]
+    indptr = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum(np.bincount(origini, minlength=n), out=indptr[1:])
+
+    grafo = {
+        "foglio": particelle["FOGLIO"].to_numpy().astype(str),
+        "particella": particelle["PARTICELLA"].to_numpy().astype(str),
+        "indptr": indptr,
+        "indices": vicini.astype(np.int32),
+        "sorgenti": np.array(firma, dtype=np.int64),
+    }
+
+    # Prima le geometrie e poi il grafo: un grafo aggiornato ha sempre le sue geometrie
+    salva_geometrie_particelle(os.path.join(comune_dir, NOME_GEOMETRIE), particelle)
+
+    scrittura_atomica(os.path.join(comune_dir, NOME_GRAFO),
+                      lambda tmp_path: np.savez_compressed(tmp_path, **grafo))
+
+    _cache_grafi.pop(comune_dir, None)
+    return grafo
+
+
+def carica_grafo_confinanti(comune_dir, costruisci_se_mancante=True, limite_memoria_mb=LIMITE_MEMORIA_MB):
+    """
+    Ritorna il grafo delle confinanti del comune (dalla cache o dal file .npz),
+    ricalcolandolo se mancante o non allineato ai GML presenti.
+    """
+    grafo_path = os.path.join(comune_dir, NOME_GRAFO)
+    try:
+        mtime = os.path.getmtime(grafo_path)
+    except OSError:
+        mtime = None
+
+    cached = _cache_grafi.get(comune_dir)
+    if cached and mtime is not None and cached[0] == mtime:
+        return cached[1]
+
+    grafo = None
+    if mtime is not None:
+        try:
+            with np.load(grafo_path, allow_pickle=False) as dati:
+                grafo = {k: dati[k] for k in dati.files}
+            map_file, ple_file = trova_file_gml(comune_dir)
+            if (not map_file or not ple_file
+                    or grafo["sorgenti"].tolist() != _firma_sorgenti(map_file, ple_file)):
+                grafo = None
+        except Exception:
+            grafo = None
+
+    if grafo is None:
+        if not costruisci_se_mancante:
+            return None
+        grafo = costruisci_grafo_confinanti(comune_dir, limite_memoria_mb)
+        if grafo is None:
+            return None
+        mtime = os.path.getmtime(grafo_path)
+
+    _cache_grafi[comune_dir] = (mtime, grafo)
+    return grafo
+
+
+def salva_geometrie_particelle(path, particelle):
+    """
+    Scrive in path (GeoPackage) la colonna POSIZIONE e la geometria di ogni
+    particella, nell'ordine del _ple.gml: le feature di una tabella nuova
+    ricevono FID progressivi, quindi FID = posizione + 1.
+    """
+    geometrie = gpd.GeoDataFrame({"POSIZIONE": np.arange(len(particelle), dtype=np.int64)},
+                                 geometry=particelle.geometry.values, crs=particelle.crs)
+
+    def scrivi(tmp_path):
+        os.remove(tmp_path)  # il GeoPackage è creato dal driver, non su un file vuoto
+        geometrie.to_file(tmp_path, layer="particelle", driver="GPKG")
+
+    scrittura_atomica(path, scrivi)
+
+
+def geometrie_per_posizione(comune_dir, posizioni, limite_memoria_mb=LIMITE_MEMORIA_MB):
+    """
+    Geometrie delle particelle nelle posizioni indicate (ordine del _ple.gml),
+    come GeoDataFrame con indice = posizione e colonna geometry.
+    Legge per FID il GeoPackage salvato con il grafo se è allineato ai GML;
+    altrimenti (dataset indicizzati prima delle geometrie) rilegge il _ple.gml.
+    """
+    posizioni = sorted({int(p) for p in posizioni})
+    map_file, ple_file = trova_file_gml(comune_dir)
+    path = os.path.join(comune_dir, NOME_GEOMETRIE)
+    if (map_file and ple_file and os.path.exists(path)
+            and os.path.getmtime(path) >= max(os.path.getmtime(map_file), os.path.getmtime(ple_file))):
+        filtro = f"fid IN ({', '.join(str(p + 1) for p in posizioni)})" if posizioni else "fid < 1"
+        letti = gpd.read_file(path, layer="particelle", where=filtro)
+        return letti.set_index("POSIZIONE")[["geometry"]]
+
+    richieste = set(posizioni)
+
+    def filtra_posizioni(blocco):
+        return blocco.loc[blocco.index.isin(richieste), ["geometry"]]
+
+    return leggi_gml_filtrato(ple_file, filtra_posizioni, limite_memoria_mb)
+
+
+def particelle_con_confinanti(grafo, foglio, particelle, anelli):
+    """
+    Visita in ampiezza del grafo a partire dalle particelle indicate del foglio.
+    Ritorna un dict posizione -> anello (0 = particella richiesta, 1 = confinante
+    diretta, ...) fino ad "anelli" livelli di distanza.
+    """
+    foglio = str(foglio).strip()
+    richieste = set(particelle)
+    partenze = np.flatnonzero((grafo["foglio"] == foglio) & np.isin(grafo["particella"], list(richieste)))
+
+    indptr, indices = grafo["indptr"], grafo["indices"]
+    distanze = {int(p): 0 for p in partenze}
+    coda = deque(distanze)
+    while coda:
+        nodo = coda.popleft()
+        livello = distanze[nodo]
+        if livello >= anelli:
+            continue
+        for vicino in indices[indptr[nodo]:indptr[nodo + 1]]:
+            vicino = int(vicino)
+            if vicino not in distanze:
+                distanze[vicino] = livello + 1
+                coda.append(vicino)
+    return distanze
+
+
+# ----------------- Panoramiche semplificate -----------------
+
+def costruisci_panoramica(comune_dir, limite_memoria_mb=LIMITE_MEMORIA_MB, letti=None):
+    """
+    Genera il GeoPackage delle panoramiche semplificate del comune.
+    letti: risultato di leggi_particelle_con_fogli già disponibile (evita una
+    seconda lettura del _ple.gml). Ritorna il percorso del file o None.
+    """
+    map_file, _ = trova_file_gml(comune_dir)
+    if letti is None:
+        letti = leggi_particelle_con_fogli(comune_dir, limite_memoria_mb)
+    if not map_file or letti is None:
+        return None
+    fogli = _leggi_fogli(map_file)
+    if fogli is None:
+        return None
+
+    path = os.path.join(comune_dir, NOME_PANORAMICA)
+    salva_panoramica(path, fogli, letti[0])
+    return path
+
+
+def carica_panoramica(comune_dir, costruisci_se_mancante=True, limite_memoria_mb=LIMITE_MEMORIA_MB):
+    """
+    Percorso del GeoPackage delle panoramiche del comune, rigenerato se manca
+    o se è più vecchio dei GML. None se non disponibile.
+    """
+    map_file, ple_file = trova_file_gml(comune_dir)
+    if not map_file or not ple_file:
+        return None
+    path = os.path.join(comune_dir, NOME_PANORAMICA)
+    if os.path.exists(path) and os.path.getmtime(path) >= max(os.path.getmtime(map_file),
+                                                              os.path.getmtime(ple_file)):
+        return path
+    if not costruisci_se_mancante:
+        return None
+    return costruisci_panoramica(comune_dir, limite_memoria_mb)
+
+
+def costruisci_indici_dataset(base_dir, dialog_ui=None, progress_start=90, progress_end=100,
+                              panoramiche=False, limite_memoria_mb=LIMITE_MEMORIA_MB):
+    """
+    Calcola indice, grafo delle confinanti e impronte delle particelle per tutti
+    i comuni in base_dir (Provincia -> Comune), con il riepilogo delle variazioni
+    rispetto al rilascio precedente; con panoramiche=True genera anche le
+    panoramiche semplificate di ogni comune.
+    Aggiorna la progressBar della UI passata come dialog_ui.
+    """
+    # Import locale: il modulo resta utilizzabile anche senza interfaccia Qt
+    if dialog_ui is not None:
+        from qgis.PyQt import QtWidgets
+
+    # Nuovo rilascio: le colonne FOGLIO/PARTICELLA sono risolte di nuovo (una volta per schema)
+    azzera_schema_colonne(base_dir)
+
+    comuni_dirs = []
+    for provincia in sorted(os.listdir(base_dir)):
+        provincia_dir = os.path.join(base_dir, provincia)
+        if not os.path.isdir(provincia_dir):
+            continue
+        for comune in sorted(os.listdir(provincia_dir)):
+            comune_dir = os.path.join(provincia_dir, comune)
+            if os.path.isdir(comune_dir):
+                comuni_dirs.append(comune_dir)
+
+    totale = len(comuni_dirs)
+    riepilogo_variazioni = {}
+    for i, comune_dir in enumerate(comuni_dirs, start=1):
+        try:
+            # Un'unica lettura completa delle particelle per indice, grafo e impronte
+            letti = leggi_particelle_con_fogli(comune_dir, limite_memoria_mb)
+            costruisci_indice(comune_dir, letti=letti)
+            if letti is not None:
+                costruisci_grafo_confinanti(comune_dir, letti=letti)
+                conteggi = aggiorna_impronte(comune_dir, letti)
+                if panoramiche:
+                    costruisci_panoramica(comune_dir, letti=letti)
+                if conteggi is not None:
+                    provincia_dir, comune = os.path.split(comune_dir)
+                    riepilogo_variazioni[(os.path.basename(provincia_dir), comune)] = conteggi
+        except Exception as e:
+            print(f"Errore indicizzando {comune_dir}: {e}")
+
+        if dialog_ui and hasattr(dialog_ui, "progressBar"):
+            percent = progress_start + int(i * (progress_end - progress_start) / totale)
+            dialog_ui.progressBar.setValue(percent)
+            dialog_ui.progressBar.setFormat(f"Indicizzazione: {os.path.basename(comune_dir)}")
+            QtWidgets.QApplication.processEvents()
+
+    if riepilogo_variazioni:
+        salva_riepilogo_variazioni(base_dir, riepilogo_variazioni)
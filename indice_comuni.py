@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo indice dei comuni - Plugin Geocodifica Catastali
+Indice in memoria di tutti i comuni della Sardegna (tutte le province), costruito
+con un'unica scansione della base dati e interrogabile per prefisso e in modo
+approssimato (fuzzy) su nome e codice catastale, senza ulteriori accessi al disco.
+"""
+
+import os
+import re
+import difflib
+import unicodedata
+
+# Cartelle AdE dei comuni: codice catastale (es. A001) seguito dal nome
+_RE_CARTELLA_COMUNE = re.compile(r"^([A-Z]\d{3})[\s_\-]+(.+)$", re.IGNORECASE)
+
+# Soglia di somiglianza per le corrispondenze approssimate
+SOGLIA_FUZZY = 0.6
+
+
+def normalizza(testo):
+    """Maiuscolo, senza accenti né punteggiatura (per confronti tolleranti)."""
+    testo = unicodedata.normalize("NFKD", str(testo))
+    testo = "".join(c for c in testo if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^0-9A-Za-z]+", " ", testo).upper().split())
+
+
+def costruisci_indice_comuni(base_dir):
+    """
+    Elenco dei comuni di tutte le province di base_dir (Provincia -> Comune).
+    Ogni voce è un dict con provincia, cartella, codice, nome e chiavi normalizzate.
+    """
+    voci = []
+    if not os.path.isdir(base_dir):
+        return voci
+    for provincia in sorted(os.listdir(base_dir)):
+        provincia_dir = os.path.join(base_dir, provincia)
+        if not os.path.isdir(provincia_dir):
+            continue
+        for cartella in sorted(os.listdir(provincia_dir)):
+            if not os.path.isdir(os.path.join(provincia_dir, cartella)):
+                continue
+            m = _RE_CARTELLA_COMUNE.match(cartella)
+            codice, nome = (m.group(1).upper(), m.group(2)) if m else ("", cartella)
+            nome = nome.replace("_", " ").strip()
+            voci.append({
+                "provincia": provincia,
+                "cartella": cartella,
+                "codice": codice,
+                "nome": nome,
+                "chiave_nome": normalizza(nome),
+                "chiave_codice": codice,
+                "chiave_cartella": normalizza(cartella),
+                "chiave_provincia": normalizza(provincia),
+            })
+    return voci
+
+
+def descrizione_comune(voce):
+    """Testo mostrato nei suggerimenti: NOME (CODICE) - PROVINCIA."""
+    codice = f" ({voce['codice']})" if voce["codice"] else ""
+    return f"{voce['nome']}{codice} - {voce['provincia']}"
+
+
+def indice_nomi_comuni(voci):
+    """
+    Dizionario chiave normalizzata -> voci, con codice catastale, nome e nome
+    della cartella di ogni comune: costruito una volta per le ricerche esatte
+    di trova_comune (es. tutte le righe di una tabella).
+    """
+    indice = {}
+    for voce in voci:
+        for chiave in {voce["chiave_codice"], voce["chiave_nome"], voce["chiave_cartella"]}:
+            if chiave:
+                indice.setdefault(chiave, []).append(voce)
+    return indice
+
+
+def trova_comune(indice_nomi, testo, provincia=""):
+    """
+    Voci che corrispondono esattamente al testo (codice catastale, nome o nome
+    della cartella), eventualmente limitate alla provincia indicata.
+    indice_nomi è il dizionario di indice_nomi_comuni.
+    """
+    candidati = indice_nomi.get(normalizza(testo), [])
+    provincia = normalizza(provincia)
+    if provincia:
+        candidati = [voce for voce in candidati if voce["chiave_provincia"] == provincia]
+    return list(candidati)
+
+
+def cerca_comuni(voci, testo, limite=20):
+    """
+    Comuni che corrispondono al testo, in ordine di rilevanza:
+    codice esatto, prefisso di codice/nome/parola del nome, sottostringa del nome
+    e infine somiglianza approssimata sul nome.
+    """
+    chiave = normalizza(testo)
+    if not chiave:
+        return []
+
+    punteggi = []
+    for i, voce in enumerate(voci):
+        nome, codice = voce["chiave_nome"], voce["chiave_codice"]
+        if codice and codice == chiave:
+            rango = 0
+        elif nome.startswith(chiave) or (codice and codice.startswith(chiave)):
+            rango = 1
+        elif any(parola.startswith(chiave) for parola in nome.split()):
+            rango = 2
+        elif chiave in nome:
+            rango = 3
+        else:
+            continue
+        punteggi.append((rango, nome, i))
+
+    trovati = {i for _, _, i in punteggi}
+    if len(punteggi) < limite:
+        # Corrispondenze approssimate (errori di battitura) sui nomi rimanenti
+        matcher = difflib.SequenceMatcher(autojunk=False)
+        matcher.set_seq2(chiave)
+        for i, voce in enumerate(voci):
+            if i in trovati:
+                continue
+            matcher.set_seq1(voce["chiave_nome"][:len(chiave) + 3])
+            if matcher.real_quick_ratio() < SOGLIA_FUZZY or matcher.quick_ratio() < SOGLIA_FUZZY:
+                continue
+            rapporto = matcher.ratio()
+            if rapporto >= SOGLIA_FUZZY:
+                punteggi.append((4 + (1 - rapporto), voce["chiave_nome"], i))
+
+    punteggi.sort()
+    return [voci[i] for _, _, i in punteggi[:limite]]
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo creazione layer QGIS - Plugin Geocodifica Catastali
+Conversione GeoDataFrame -> layer in memoria, comune a entrambi i dialog,
+layer di sessione "accumulatori" aggiornati per (foglio, particella) e gruppo
+di panoramica del comune con visibilità dipendente dalla scala.
+"""
+
+from qgis.core import (
+    QgsVectorLayer,
+    QgsProject,
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsGeometry,
+    QgsFields,
+    QgsField,
+    QgsWkbTypes,
+    QgsFillSymbol,
+)
+from PyQt5.QtCore import QDateTime, QVariant
+import pandas as pd
+
+# Colonne chiave dei layer di sessione
+CHIAVI_ACCUMULO = ("FOGLIO", "PARTICELLA")
+
+# Layer di sessione: nome layer -> (id layer, {(foglio, particella): (fid, impronta)},
+# fid modificati o eliminati dall'utente dopo l'ultimo aggiornamento)
+_layer_accumulo = {}
+
+
+def _tipo_geometrico(gdf):
+    """Tipo geometrico del layer: MultiPolygon se presente."""
+    geom_types = gdf.geom_type.unique().tolist()
+    if any(gt == 'MultiPolygon' for gt in geom_types):
+        return QgsWkbTypes.MultiPolygon
+    elif any(gt == 'Polygon' for gt in geom_types):
+        return QgsWkbTypes.Polygon
+    return QgsWkbTypes.Unknown
+
+
+def _campi_da_gdf(gdf):
+    """Schema attributi QGIS dalle colonne (non geometriche) del GeoDataFrame."""
+    fields = QgsFields()
+    for col_name, dtype in zip(gdf.columns, gdf.dtypes):
+        if col_name == gdf.geometry.name:
+            continue
+        dtypestr = str(dtype)
+        if 'int' in dtypestr:
+            fields.append(QgsField(col_name, QVariant.Int))
+        elif 'float' in dtypestr:
+            fields.append(QgsField(col_name, QVariant.Double))
+        elif 'bool' in dtypestr:
+            fields.append(QgsField(col_name, QVariant.Bool))
+        elif dtypestr.startswith('datetime64'):
+            fields.append(QgsField(col_name, QVariant.DateTime))
+        else:
+            fields.append(QgsField(col_name, QVariant.String))
+    return fields
+
+
+def _testo(valore):
+    """Testo di un valore non primitivo (date e orari in formato ISO)."""
+    return valore.isoformat() if hasattr(valore, "isoformat") else str(valore)
+
+
+def _valori_colonna(serie, tipo):
+    """
+    Valori della colonna accettati dal provider per il tipo del campo: None per
+    i nulli, QDateTime per i campi data/ora, testo per gli oggetti (es.
+    Timestamp in colonne object) destinati ai campi String.
+    """
+    valori = serie.astype(object).where(serie.notna(), None).tolist()
+    if tipo == QVariant.DateTime:
+        return [None if v is None else QDateTime(pd.Timestamp(v).to_pydatetime()) for v in valori]
+    if tipo == QVariant.String:
+        return [v if v is None or isinstance(v, str) else _testo(v) for v in valori]
+    return valori
+
+
+def _valori_righe(gdf, fields):
+    """Valori degli attributi per riga, nell'ordine dei campi, convertiti per tipo di campo."""
+    colonne = [_valori_colonna(gdf[campo.name()], campo.type()) for campo in fields]
+    return [list(riga) for riga in zip(*colonne)] if colonne else [[] for _ in range(len(gdf))]
+
+
+def crea_feature(gdf, fields):
+    """
+    Converte le righe del GeoDataFrame in QgsFeature.
+    Geometrie via WKB e attributi convertiti una volta per colonna secondo il
+    tipo del campo, evitando iterrows e il passaggio per WKT.
+    """
+    wkb_list = gdf.geometry.to_wkb().tolist()
+    valori = _valori_righe(gdf, fields)
+
+    features = []
+    for wkb, attr_values in zip(wkb_list, valori):
+        feat = QgsFeature(fields)
+        if wkb is not None:
+            geom = QgsGeometry()
+            geom.fromWkb(wkb)
+            feat.setGeometry(geom)
+        feat.setAttributes(attr_values)
+        features.append(feat)
+    return features
+
+
+def crea_layer_memoria(gdf, layer_name):
+    """Crea un layer QGIS in memoria con schema e feature del GeoDataFrame."""
+    # CRS dal GeoDataFrame oppure EPSG:3003 come default prudenziale
+    crs = gdf.crs.to_string() if gdf.crs else 'EPSG:3003'
+    uri = f"{QgsWkbTypes.displayString(_tipo_geometrico(gdf))}?crs={crs}"
+
+    mem_layer = QgsVectorLayer(uri, layer_name, "memory")
+    provider = mem_layer.dataProvider()
+    provider.addAttributes(_campi_da_gdf(gdf))
+    mem_layer.updateFields()
+
+    provider.addFeatures(crea_feature(gdf, mem_layer.fields()))
+    mem_layer.updateExtents()
+    return mem_layer
+
+
+def aggiungi_layer_progetto(layer):
+    """Aggiunge il layer al progetto, rimuovendo eventuali layer con lo stesso nome."""
+    existing = [lyr for lyr in QgsProject.instance().mapLayers().values()
+                if lyr.name() == layer.name()]
+    for lyr in existing:
+        QgsProject.instance().removeMapLayer(lyr.id())
+
+    QgsProject.instance().addMapLayer(layer)
+
+
+def _chiave(valori):
+    """Chiave normalizzata (foglio, particella) di una riga."""
+    return tuple(str(v).strip() for v in valori)
+
+
+def _registra_modifiche_utente(layer, modificati):
+    """Annota in modificati i fid cambiati o eliminati con le modifiche salvate dall'utente."""
+    layer.committedFeaturesRemoved.connect(lambda _, fids: modificati.update(fids))
+    layer.committedGeometriesChanges.connect(lambda _, geometrie: modificati.update(geometrie.keys()))
+    layer.committedAttributeValuesChanges.connect(lambda _, attributi: modificati.update(attributi.keys()))
+
+
+def _indice_da_layer(layer, indice, modificati):
+    """
+    Ricostruisce l'indice (foglio, particella) -> (fid, impronta) dagli attributi
+    del layer. L'impronta nota è conservata solo per i fid ancora presenti e non
+    modificati dall'utente: le particelle eliminate sono aggiunte di nuovo e
+    quelle modificate sono riscritte alla ricerca successiva.
+    """
+    impronte = {fid: impronta for fid, impronta in indice.values()}
+    richiesta = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+    richiesta.setSubsetOfAttributes(list(CHIAVI_ACCUMULO), layer.fields())
+    ricostruito = {}
+    for feat in layer.getFeatures(richiesta):
+        fid = feat.id()
+        impronta = None if fid in modificati else impronte.get(fid)
+        ricostruito[_chiave(feat[c] for c in CHIAVI_ACCUMULO)] = (fid, impronta)
+    modificati.clear()
+    return ricostruito
+
+
+def accumula_in_layer(gdf, layer_name):
+    """
+    Upsert delle particelle del GeoDataFrame nel layer di sessione layer_name
+    (uno per comune), indicizzato per (FOGLIO, PARTICELLA): aggiunge le
+    particelle nuove, aggiorna quelle con geometria/attributi cambiati e salta
+    quelle già presenti. Il layer è creato (e aggiunto al progetto) al primo
+    utilizzo o se l'utente lo ha rimosso.
+    Ritorna (layer, aggiunte, aggiornate, invariate).
+    """
+    progetto = QgsProject.instance()
+    layer_id, indice, modificati = _layer_accumulo.get(layer_name, (None, None, None))
+    layer = progetto.mapLayer(layer_id) if layer_id else None
+    if layer is not None and any(layer.fields().indexOf(c) < 0 for c in CHIAVI_ACCUMULO):
+        layer = None  # campi chiave rimossi dall'utente: si ricrea il layer
+
+    # Una sola riga per chiave (vince l'ultima)
+    chiavi = [_chiave(v) for v in gdf[list(CHIAVI_ACCUMULO)].values.tolist()]
+    unici = ~pd.Series(chiavi).duplicated(keep="last").values
+    if not unici.all():
+        gdf = gdf[unici]
+        chiavi = [c for c, u in zip(chiavi, unici) if u]
+
+    # Impronta di ogni riga: WKB della geometria + valori degli attributi
+    campi_gdf = _campi_da_gdf(gdf)
+    colonne_attr = campi_gdf.names()
+    valori = _valori_righe(gdf, campi_gdf)
+    wkb_list = gdf.geometry.to_wkb().tolist()
+    impronte = [hash((wkb, tuple(map(str, attr_values)))) for wkb, attr_values in zip(wkb_list, valori)]
+
+    if layer is None:
+        layer = crea_layer_memoria(gdf, layer_name)
+        # Come per gli altri layer: sostituisce un omonimo (es. da un progetto riaperto)
+        aggiungi_layer_progetto(layer)
+        # Il provider memory assegna i fid nell'ordine di inserimento
+        fids = [feat.id() for feat in layer.getFeatures()]
+        indice = {chiave: (fid, impronta) for chiave, fid, impronta in zip(chiavi, fids, impronte)}
+        modificati = set()
+        _registra_modifiche_utente(layer, modificati)
+        _layer_accumulo[layer_name] = (layer.id(), indice, modificati)
+        return layer, len(indice), 0, 0
+
+    # Indice allineato al layer: feature eliminate o modificate dall'utente
+    if modificati or layer.featureCount() != len(indice):
+        indice = _indice_da_layer(layer, indice, modificati)
+        _layer_accumulo[layer_name] = (layer.id(), indice, modificati)
+
+    provider = layer.dataProvider()
+
+    # Eventuali nuove colonne (es. attributi calcolati) aggiunte allo schema
+    nuovi_campi = [f for f in campi_gdf if layer.fields().indexOf(f.name()) < 0]
+    if nuovi_campi:
+        provider.addAttributes(nuovi_campi)
+        layer.updateFields()
+
+    fields = layer.fields()
+    idx_campi = [fields.indexOf(c) for c in colonne_attr]
+
+    nuove = []
+    geometrie_modificate, attributi_modificati = {}, {}
+    invariate = 0
+    for chiave, wkb, attr_values, impronta in zip(chiavi, wkb_list, valori, impronte):
+        if chiave in indice:
+            fid, impronta_attuale = indice[chiave]
+            if impronta == impronta_attuale:
+                invariate += 1
+                continue
+            geom = QgsGeometry()
+            geom.fromWkb(wkb)
+            geometrie_modificate[fid] = geom
+            attributi_modificati[fid] = dict(zip(idx_campi, attr_values))
+            indice[chiave] = (fid, impronta)
+            continue
+
+        feat = QgsFeature(fields)
+        geom = QgsGeometry()
+        geom.fromWkb(wkb)
+        feat.setGeometry(geom)
+        for i, v in zip(idx_campi, attr_values):
+            feat.setAttribute(i, v)
+        nuove.append((chiave, impronta, feat))
+
+    if geometrie_modificate:
+        provider.changeGeometryValues(geometrie_modificate)
+        provider.changeAttributeValues(attributi_modificati)
+
+    if nuove:
+        ok, aggiunte = provider.addFeatures([feat for _, _, feat in nuove])
+        if ok:
+            for (chiave, impronta, _), feat in zip(nuove, aggiunte):
+                indice[chiave] = (feat.id(), impronta)
+
+    layer.updateExtents()
+    layer.triggerRepaint()
+    return layer, len(nuove), len(geometrie_modificate), invariate
+
+
+# ----------------- Gruppo di panoramica -----------------
+
+# Stile dei layer di panoramica: solo contorni, fogli più marcati delle particelle
+STILE_PANORAMICA = {
+    "fogli": {"color": "0,0,0,0", "outline_color": "200,30,30", "outline_width": "0.6"},
+    "particelle": {"color": "0,0,0,0", "outline_color": "90,90,90", "outline_width": "0.2"},
+}
+
+
+def aggiungi_gruppo_panoramica(nome_gruppo, voci):
+    """
+    Aggiunge al progetto un gruppo di layer OGR con visibilità per scala.
+    voci: elenco di (uri, nome layer, tipo "fogli"/"particelle", scala 1:N più
+    grande, scala 1:N più piccola; 0 = nessun limite). Un gruppo con lo stesso
+    nome già presente viene sostituito. Ritorna il numero di layer aggiunti.
+    """
+    progetto = QgsProject.instance()
+    radice = progetto.layerTreeRoot()
+    esistente = radice.findGroup(nome_gruppo)
+    if esistente is not None:
+        for nodo in esistente.findLayers():
+            progetto.removeMapLayer(nodo.layerId())
+        radice.removeChildNode(esistente)
+
+    gruppo = radice.insertGroup(0, nome_gruppo)
+    aggiunti = 0
+    for uri, nome, tipo, scala_grande, scala_piccola in voci:
+        layer = QgsVectorLayer(uri, nome, "ogr")
+        if not layer.isValid():
+            continue
+        layer.renderer().setSymbol(QgsFillSymbol.createSimple(STILE_PANORAMICA[tipo]))
+        layer.setScaleBasedVisibility(True)
+        # In QGIS minimumScale è il limite "più lontano", maximumScale il più vicino
+        layer.setMinimumScale(scala_piccola)
+        layer.setMaximumScale(scala_grande)
+        progetto.addMapLayer(layer, False)
+        gruppo.addLayer(layer)
+        aggiunti += 1
+    return aggiunti
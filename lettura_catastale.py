@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo lettura dataset catastale - Plugin Geocodifica Catastali
+(individuazione file GML, risoluzione colonne FOGLIO/PARTICELLA con cache
+persistente per rilascio e lettura a blocchi dei GML di grandi dimensioni,
+senza dipendenze da QGIS)
+"""
+
+import os
+import json
+import tempfile
+import pandas as pd
+import geopandas as gpd
+
+# Alias ammessi per le colonne FOGLIO e PARTICELLA nei GML AdE
+ALIASES_FOGLIO = ["label", "foglio", "codfoglio", "cod_foglio", "num_foglio", "n_foglio", "foglio_n"]
+ALIASES_PARTICELLA = ["label", "particella", "numero", "num_part", "n_part", "num_particella",
+                      "ident", "identificativo", "id_particella"]
+
+# Alias per tipo di colonna risolta
+ALIASES_PER_TIPO = {"FOGLIO": ALIASES_FOGLIO, "PARTICELLA": ALIASES_PARTICELLA}
+
+# Colonne risolte per schema dei GML, salvate accanto alla cartella della base dati
+# (es. Sardegna_schema_colonne.json) e azzerate a ogni nuovo scaricamento.
+# Non dentro la cartella: la sua data di modifica è la data dell'ultimo scaricamento.
+NOME_SCHEMA_COLONNE = "schema_colonne.json"
+
+# Oltre questa dimensione (MB) il GML non viene caricato per intero ma letto a blocchi.
+# Valore predefinito, modificabile dall'utente (campo MEMORIA del dialog, salvato in QSettings).
+LIMITE_MEMORIA_MB = 256
+
+# Numero di feature per blocco nella lettura a blocchi
+DIMENSIONE_BLOCCO_LETTURA = 20000
+
+# Cache in memoria: (file GML, dimensione, mtime, tipo) -> colonna risolta
+_cache_colonne = {}
+
+# Cache in memoria: file schema -> (mtime, contenuto)
+_cache_schema = {}
+
+
+def trova_file_gml(comune_dir):
+    """
+    Individua i file catastali *_map.gml e *_ple.gml nella cartella del comune.
+    Ritorna la coppia (map_file, ple_file); None per i file non trovati.
+    """
+    map_file, ple_file = None, None
+    for filename in os.listdir(comune_dir):
+        if filename.endswith('_map.gml'):
+            map_file = os.path.join(comune_dir, filename)
+        elif filename.endswith('_ple.gml'):
+            ple_file = os.path.join(comune_dir, filename)
+    return map_file, ple_file
+
+
+def chiave_etichetta(etichetta):
+    """Chiave di ordinamento "naturale" per etichette di fogli/particelle (es. 2 < 10 < 100)."""
+    return (len(etichetta), etichetta)
+
+
+def _pick_column(df, aliases):
+    """
+    Restituisce il nome della prima colonna in df che corrisponde (case-insensitive)
+    a uno degli alias forniti. Gestisce eventuali suffissi '_1', '_2' tipici di overlay.
+    df può essere un DataFrame oppure direttamente un elenco di nomi di campo.
+    """
+    cols = list(getattr(df, "columns", df))
+
+    def base_name(name: str) -> str:
+        n = name.lower()
+        for suf in ("_1", "_2"):
+            if n.endswith(suf):
+                return n[:-len(suf)]
+        return n
+
+    aliases_low = [a.lower() for a in aliases]
+
+    # Match diretto sull'elenco colonne (dopo normalizzazione)
+    for col in cols:
+        if base_name(col) in aliases_low:
+            return col
+
+    # Fallback: match "contains" per maggiore tolleranza
+    for col in cols:
+        b = base_name(col)
+        if any(b == a or a in b for a in aliases_low):
+            return col
+
+    return None
+
+
+def _friendly_cols(df):
+    """Ritorna stringa con l'elenco delle colonne (per messaggi d'errore)."""
+    return ", ".join(map(str, getattr(df, "columns", df)))
+
+
+# ----------------- Cache dello schema delle colonne -----------------
+
+def campi_layer(path):
+    """
+    Nomi dei campi del primo layer del file, letti dallo schema OGR senza
+    caricare le feature (per i GML lo schema è nel .gfs creato alla prima apertura).
+    """
+    # Import locale: GDAL/OGR è sempre disponibile nell'ambiente QGIS
+    from osgeo import ogr
+
+    ds = ogr.Open(path)
+    if ds is None:
+        raise RuntimeError(f"Impossibile aprire il file:\n{path}")
+    defn = ds.GetLayer(0).GetLayerDefn()
+    return [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+
+
+def _percorso_schema_base(base_dir):
+    """File dello schema della base dati, nella cartella che la contiene."""
+    base_dir = os.path.abspath(base_dir)
+    return os.path.join(os.path.dirname(base_dir), f"{os.path.basename(base_dir)}_{NOME_SCHEMA_COLONNE}")
+
+
+def _percorso_schema(path):
+    """File dello schema per un GML della base dati (Sardegna -> Provincia -> Comune -> GML)."""
+    return _percorso_schema_base(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(path)))))
+
+
+def _leggi_schema(schema_path):
+    try:
+        mtime = os.path.getmtime(schema_path)
+    except OSError:
+        return {}
+    in_cache = _cache_schema.get(schema_path)
+    if in_cache is not None and in_cache[0] == mtime:
+        return in_cache[1]
+    try:
+        with open(schema_path, "r", encoding="utf-8") as f:
+            dati = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    _cache_schema[schema_path] = (mtime, dati)
+    return dati
+
+
+def scrittura_atomica(path, scrivi):
+    """
+    Scrive path in modo atomico: scrivi(tmp_path) produce il file in un
+    temporaneo univoco della stessa cartella (tempfile.mkstemp, stessa
+    estensione), poi sostituito a path con os.replace. Più sessioni QGIS su
+    una cartella dati condivisa non scrivono mai sullo stesso temporaneo;
+    in caso di errore il temporaneo è rimosso.
+    """
+    cartella, nome = os.path.split(os.path.abspath(path))
+    radice, estensione = os.path.splitext(nome)
+    fd, tmp_path = tempfile.mkstemp(prefix=f"{radice}.", suffix=f".tmp{estensione}", dir=cartella)
+    os.close(fd)
+    try:
+        scrivi(tmp_path)
+        # mkstemp crea il file leggibile solo dal proprietario: permessi ordinari (umask)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _scrivi_schema(schema_path, dati):
+    """Scrittura atomica del file schema (temporaneo univoco + rename)."""
+    def scrivi(tmp_path):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(dati, f, ensure_ascii=False, indent=1)
+
+    scrittura_atomica(schema_path, scrivi)
+    _cache_schema[schema_path] = (os.path.getmtime(schema_path), dati)
+
+
+def colonna_catastale(path, tipo):
+    """
+    Nome della colonna FOGLIO o PARTICELLA (tipo) del GML indicato, None se
+    nessun campo corrisponde agli alias. La corrispondenza alias -> colonna è
+    calcolata una volta per schema (elenco dei campi) e salvata nel file
+    schema della base dati: per gli altri comuni dello stesso rilascio basta
+    confrontare l'elenco dei campi, senza leggere le feature.
+    """
+    stat = os.stat(path)
+    chiave = (path, stat.st_size, int(stat.st_mtime), tipo)
+    if chiave in _cache_colonne:
+        return _cache_colonne[chiave]
+
+    campi = campi_layer(path)
+    firma = "|".join(campi)
+    schema_path = _percorso_schema(path)
+    dati = _leggi_schema(schema_path)
+    risolte = dati.get(tipo, {})
+
+    if firma in risolte and (risolte[firma] is None or risolte[firma] in campi):
+        colonna = risolte[firma]
+    else:
+        colonna = _pick_column(campi, ALIASES_PER_TIPO[tipo])
+        dati = {**dati, tipo: {**risolte, firma: colonna}}
+        try:
+            _scrivi_schema(schema_path, dati)
+        except OSError:
+            pass  # cartella non scrivibile: resta la cache in memoria
+
+    _cache_colonne[chiave] = colonna
+    return colonna
+
+
+def azzera_schema_colonne(base_dir):
+    """Elimina le colonne risolte del rilascio precedente (nuovo scaricamento)."""
+    schema_path = _percorso_schema_base(base_dir)
+    if os.path.exists(schema_path):
+        os.remove(schema_path)
+    _cache_schema.pop(schema_path, None)
+    _cache_colonne.clear()
+
+
+# ----------------- Lettura GML (intera o a blocchi) -----------------
+
+def usa_lettura_a_blocchi(path, limite_memoria_mb=LIMITE_MEMORIA_MB):
+    """True se il file supera il limite di memoria e va quindi letto a blocchi."""
+    if not limite_memoria_mb or limite_memoria_mb <= 0:
+        return False
+    return os.path.getsize(path) > limite_memoria_mb * 1024 * 1024
+
+
+def leggi_a_blocchi(path, dimensione_blocco=DIMENSIONE_BLOCCO_LETTURA):
+    """
+    Legge il file vettoriale in GeoDataFrame di al più dimensione_blocco feature.
+    L'indice di ogni blocco è la posizione della feature nel file (come in una
+    lettura completa), così i filtri per posizione funzionano in entrambi i modi.
+    Genera sempre almeno un blocco (eventualmente vuoto) con lo schema del file.
+    """
+    # Import locale: GDAL/OGR è sempre disponibile nell'ambiente QGIS
+    from osgeo import ogr
+
+    ds = ogr.Open(path)
+    if ds is None:
+        raise RuntimeError(f"Impossibile aprire il file:\n{path}")
+    lyr = ds.GetLayer(0)
+    defn = lyr.GetLayerDefn()
+    nomi = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+    srs = lyr.GetSpatialRef()
+    crs = srs.ExportToWkt() if srs is not None else None
+
+    def crea_blocco(righe, wkb, inizio):
+        indice = pd.RangeIndex(inizio, inizio + len(righe))
+        geometrie = gpd.GeoSeries.from_wkb(wkb, index=indice, crs=crs)
+        return gpd.GeoDataFrame(pd.DataFrame(righe, columns=nomi, index=indice),
+                                geometry=geometrie, crs=crs)
+
+    inizio = 0
+    righe, wkb = [], []
+    lyr.ResetReading()
+    feat = lyr.GetNextFeature()
+    while feat is not None:
+        righe.append([feat.GetField(i) for i in range(len(nomi))])
+        geom = feat.GetGeometryRef()
+        if geom is not None and geom.HasCurveGeometry():
+            # Archi linearizzati come nella lettura completa (gpd.read_file)
+            geom = geom.GetLinearGeometry()
+        wkb.append(bytes(geom.ExportToWkb()) if geom is not None else None)
+        if len(righe) >= dimensione_blocco:
+            yield crea_blocco(righe, wkb, inizio)
+            inizio += len(righe)
+            righe, wkb = [], []
+        feat = lyr.GetNextFeature()
+
+    if righe or inizio == 0:
+        yield crea_blocco(righe, wkb, inizio)
+
+
+def leggi_gml_filtrato(path, filtro, limite_memoria_mb=LIMITE_MEMORIA_MB,
+                       dimensione_blocco=DIMENSIONE_BLOCCO_LETTURA):
+    """
+    Legge il GML applicando filtro(gdf) -> gdf e ritorna solo le righe tenute.
+    Sotto il limite di memoria il file è caricato per intero e filtrato;
+    sopra il limite è letto a blocchi di dimensione fissa e di ogni blocco
+    si conservano solo le righe selezionate dal filtro.
+    """
+    if not usa_lettura_a_blocchi(path, limite_memoria_mb):
+        return filtro(gpd.read_file(path))
+
+    parti = [filtro(blocco) for blocco in leggi_a_blocchi(path, dimensione_blocco)]
+    risultato = pd.concat(parti) if len(parti) > 1 else parti[0]
+    return gpd.GeoDataFrame(risultato, geometry="geometry", crs=parti[0].crs)
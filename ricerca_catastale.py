@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo ricerca particelle - Plugin Geocodifica Catastali
+Logica di ricerca foglio/particelle indipendente dall'interfaccia: usata dal
+dialog QGIS e dal servizio locale HTTP (senza dipendenze da QGIS).
+"""
+
+import geopandas as gpd
+
+from .lettura_catastale import (
+    LIMITE_MEMORIA_MB,
+    _friendly_cols,
+    campi_layer,
+    colonna_catastale,
+    leggi_gml_filtrato,
+    trova_file_gml,
+)
+
+
+class ErroreRicerca(Exception):
+    """
+    Errore della ricerca, con titolo e livello (critico o semplice avviso)
+    per la segnalazione all'utente.
+    """
+
+    def __init__(self, titolo, messaggio, critico=False):
+        super().__init__(messaggio)
+        self.titolo = titolo
+        self.messaggio = messaggio
+        self.critico = critico
+
+    def __reduce__(self):
+        # Ricostruzione con tutti gli argomenti: l'errore attraversa i processi worker del servizio
+        return (type(self), (self.titolo, self.messaggio, self.critico))
+
+
+def carica_dati_comune(comune_dir, particelle=None, limite_memoria_mb=LIMITE_MEMORIA_MB):
+    """
+    Legge i GML del comune e ritorna (fogli, particelle): GeoDataFrame minimi con
+    colonna FOGLIO / PARTICELLA (etichette normalizzate) e geometry.
+    Se particelle è indicato, del _ple.gml sono conservate solo quelle etichette
+    (filtro applicato in lettura, anche nella lettura a blocchi).
+    """
+    map_file, ple_file = trova_file_gml(comune_dir)
+    if not map_file or not ple_file:
+        raise ErroreRicerca("Errore", "File catastali '_map.gml' o '_ple.gml' non trovati nella cartella.",
+                            critico=True)
+
+    # Risoluzione nomi colonna (FOGLIO e PARTICELLA) dallo schema, prima della lettura
+    try:
+        col_foglio = colonna_catastale(map_file, "FOGLIO")
+        col_part = colonna_catastale(ple_file, "PARTICELLA")
+    except Exception as e:
+        raise ErroreRicerca("Errore", f"Errore caricamento file GML:\n{str(e)}", critico=True)
+
+    if not col_foglio:
+        raise ErroreRicerca(
+            "Campo FOGLIO non trovato",
+            "Impossibile individuare la colonna del FOGLIO nel file _map.gml.\n"
+            f"Colonne disponibili: { _friendly_cols(campi_layer(map_file)) }",
+            critico=True,
+        )
+
+    if not col_part:
+        raise ErroreRicerca(
+            "Campo PARTICELLA non trovato",
+            "Impossibile individuare la colonna della PARTICELLA nel file _ple.gml.\n"
+            f"Colonne disponibili: { _friendly_cols(campi_layer(ple_file)) }",
+            critico=True,
+        )
+
+    richieste = set(particelle) if particelle is not None else None
+
+    def filtra_particelle(blocco):
+        if richieste is None:
+            return blocco
+        return blocco[blocco[col_part].astype(str).str.strip().isin(richieste)]
+
+    # Lettura GML
+    try:
+        gdf_map = gpd.read_file(map_file)
+        gdf_ple = leggi_gml_filtrato(ple_file, filtra_particelle, limite_memoria_mb)
+    except Exception as e:
+        raise ErroreRicerca("Errore", f"Errore caricamento file GML:\n{str(e)}", critico=True)
+
+    # Copie minimali con rinomina per evitare suffissi dopo overlay
+    fogli = gdf_map[[col_foglio, "geometry"]].copy().rename(columns={col_foglio: "FOGLIO"})
+    fogli["FOGLIO"] = fogli["FOGLIO"].astype(str).str.strip()
+    particelle_gdf = gdf_ple[[col_part, "geometry"]].copy().rename(columns={col_part: "PARTICELLA"})
+    particelle_gdf["PARTICELLA"] = particelle_gdf["PARTICELLA"].astype(str).str.strip()
+    return fogli, particelle_gdf
+
+
+def cerca_particelle(fogli, particelle_gdf, num_foglio, particelle_list):
+    """
+    Seleziona le particelle richieste del foglio indicato (particelle ∩ foglio).
+    fogli e particelle_gdf sono quelli di carica_dati_comune.
+    Ritorna (particelle_in_foglio, mancanti) con mancanti = etichette richieste
+    non trovate nel foglio; solleva ErroreRicerca se non c'è alcun risultato.
+    """
+    num_foglio = str(num_foglio).strip()
+
+    # Filtro FOGLIO
+    foglio_sel = fogli[fogli["FOGLIO"] == num_foglio]
+    if foglio_sel.empty:
+        raise ErroreRicerca(
+            "Foglio non trovato",
+            f"Foglio '{num_foglio}' non trovato.\n"
+            f"(Campo usato: FOGLIO; esempi presenti: "
+            f"{', '.join(map(str, fogli['FOGLIO'].unique()[:10]))} ... )"
+        )
+
+    # Filtro PARTICELLA
+    particella_sel = particelle_gdf[particelle_gdf["PARTICELLA"].isin(particelle_list)]
+    if particella_sel.empty:
+        raise ErroreRicerca(
+            "Particelle non trovate",
+            f"Nessuna delle particelle richieste ({', '.join(particelle_list)}) è presente."
+        )
+
+    # Intersezione spaziale: particelle ∩ foglio
+    try:
+        particelle_in_foglio = gpd.overlay(particella_sel, foglio_sel, how='intersection')
+    except Exception as e:
+        raise ErroreRicerca("Errore spaziale", f"Errore durante l'intersezione spaziale:\n{e}", critico=True)
+
+    if particelle_in_foglio.empty:
+        raise ErroreRicerca("Errore spaziale", "Le particelle selezionate non ricadono nel foglio indicato.")
+
+    trovate = set(particelle_in_foglio["PARTICELLA"].unique())
+    mancanti = sorted(set(particelle_list) - trovate)
+    return particelle_in_foglio, mancanti
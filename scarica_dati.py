@@ -8,6 +8,9 @@ import zipfile
 import requests
 from qgis.PyQt import QtWidgets
 
+from .lettura_catastale import LIMITE_MEMORIA_MB
+from .indice_catastale import costruisci_indici_dataset
+
 # URL dataset catastale
 DATASET_URL = "https://wfs.cartografia.agenziaentrate.gov.it/inspire/wfs/GetDataset.php?dataset=SARDEGNA.zip"
 
@@ -16,10 +19,13 @@ PLUGIN_DIR = os.path.dirname(__file__)
 DEST_DIR = PLUGIN_DIR  # i dati saranno salvati in PLUGIN_DIR/Sardegna
 
 
-def scarica_e_scompatta_dataset(url=DATASET_URL, dest_dir=DEST_DIR, dialog_ui=None):
+def scarica_e_scompatta_dataset(url=DATASET_URL, dest_dir=DEST_DIR, dialog_ui=None, panoramiche=False,
+                                limite_memoria_mb=LIMITE_MEMORIA_MB):
     """
     Scarica il dataset catastale e lo estrae mantenendo la gerarchia:
     Sardegna -> Province -> Comuni.
+    Con panoramiche=True genera anche le panoramiche semplificate dei comuni;
+    limite_memoria_mb è il limite oltre il quale i GML sono letti a blocchi.
     Aggiorna la progressBar della UI passata come dialog_ui.
     """
 
@@ -71,6 +77,10 @@ def scarica_e_scompatta_dataset(url=DATASET_URL, dest_dir=DEST_DIR, dialog_ui=No
 
         os.remove(zip_path)
 
+        # --- Indici fogli/particelle per l'autocompletamento ---
+        costruisci_indici_dataset(sardegna_dir, dialog_ui, panoramiche=panoramiche,
+                                  limite_memoria_mb=limite_memoria_mb)  # 90-100% indicizzazione
+
         if dialog_ui and hasattr(dialog_ui, "progressBar"):
             dialog_ui.progressBar.setValue(100)
             dialog_ui.progressBar.setFormat("Completato!")
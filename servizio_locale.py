@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+"""
+Servizio locale HTTP/JSON - Plugin Geocodifica Catastali
+Server leggero attorno alla ricerca di run_geocoding, per più postazioni QGIS
+e web GIS dello stesso ufficio: i dataset dei comuni restano caricati ("caldi")
+in un gruppo di processi worker e le richieste rispondono in GeoJSON (EPSG:4326).
+
+Ogni comune è assegnato sempre allo stesso worker (hash della cartella), così
+il suo dataset viene letto dal GML una sola volta e resta in una cache LRU.
+
+Avvio dalla cartella dei plugin, con il Python di QGIS/OSGeo4W:
+    python -m GeocodificaCatastaliSardegna.servizio_locale --porta 8765 --processi 4
+
+Endpoint:
+    GET  /particelle?provincia=..&comune=..&foglio=..&particelle=1,2
+         (provincia facoltativa se il nome del comune è univoco)
+    POST /particelle   {"richieste": [{"provincia": .., "comune": .., "foglio": .., "particelle": "1,2"}, ...]}
+    GET  /comuni       elenco dei comuni disponibili
+    GET  /metriche     latenze per endpoint (media, p50, p95, max)
+"""
+
+import os
+import json
+import time
+import zlib
+import argparse
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from .lettura_catastale import LIMITE_MEMORIA_MB
+from .ricerca_catastale import ErroreRicerca, carica_dati_comune, cerca_particelle
+
+# Base dati relativa alla cartella del plugin
+PLUGIN_DIR = os.path.dirname(__file__)
+BASE_DIR = os.path.join(PLUGIN_DIR, "Sardegna")
+
+HOST_PREDEFINITO = "127.0.0.1"
+PORTA_PREDEFINITA = 8765
+
+# Dataset di comuni tenuti in memoria da ciascun worker (LRU)
+COMUNI_PER_WORKER = 8
+
+# CRS delle risposte GeoJSON (RFC 7946)
+CRS_GEOJSON = "EPSG:4326"
+
+# Campioni conservati per endpoint per il calcolo dei percentili
+CAMPIONI_METRICHE = 1000
+
+
+# ----------------- Lato worker (processi separati) -----------------
+
+_config_worker = {}
+_dati_worker = OrderedDict()
+
+
+def _inizializza_worker(limite_memoria_mb, comuni_per_worker):
+    """Initializer dei processi worker."""
+    _config_worker["limite_memoria_mb"] = limite_memoria_mb
+    _config_worker["comuni_per_worker"] = comuni_per_worker
+
+
+def _dataset_comune(comune_dir):
+    """Dataset del comune dalla cache LRU del worker; ritorna (dati, già_in_cache)."""
+    if comune_dir in _dati_worker:
+        _dati_worker.move_to_end(comune_dir)
+        return _dati_worker[comune_dir], True
+
+    dati = carica_dati_comune(comune_dir, None, _config_worker.get("limite_memoria_mb", LIMITE_MEMORIA_MB))
+    _dati_worker[comune_dir] = dati
+    while len(_dati_worker) > _config_worker.get("comuni_per_worker", COMUNI_PER_WORKER):
+        _dati_worker.popitem(last=False)
+    return dati, False
+
+
+def _precarica_comune(comune_dir):
+    """Carica il dataset del comune nella cache del worker (avvio a caldo)."""
+    _dataset_comune(comune_dir)
+    return os.getpid()
+
+
+def _esegui_ricerca(comune_dir, foglio, particelle):
+    """Ricerca nel worker; ritorna un dict serializzabile con esito e tempi."""
+    inizio = time.perf_counter()
+    in_cache = False
+    try:
+        (fogli, gdf_particelle), in_cache = _dataset_comune(comune_dir)
+        risultato, mancanti = cerca_particelle(fogli, gdf_particelle, foglio, particelle)
+        if risultato.crs is not None:
+            risultato = risultato.to_crs(CRS_GEOJSON)
+        esito = {"esito": "ok", "mancanti": mancanti, "geojson": risultato.to_json()}
+    except ErroreRicerca as e:
+        esito = {"esito": "errore", "titolo": e.titolo, "messaggio": e.messaggio, "critico": e.critico}
+    except Exception as e:
+        esito = {"esito": "errore", "titolo": "Errore", "messaggio": str(e), "critico": True}
+    esito["cache"] = in_cache
+    esito["pid"] = os.getpid()
+    esito["tempo_worker_ms"] = round((time.perf_counter() - inizio) * 1000, 2)
+    return esito
+
+
+# ----------------- Lato server -----------------
+
+class Metriche:
+    """Contatori e latenze per endpoint, condivisi tra i thread del server."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dati = {}
+
+    def registra(self, endpoint, durata_ms, errore=False):
+        with self._lock:
+            voce = self._dati.setdefault(endpoint, {
+                "richieste": 0, "errori": 0, "totale_ms": 0.0, "max_ms": 0.0,
+                "campioni": deque(maxlen=CAMPIONI_METRICHE),
+            })
+            voce["richieste"] += 1
+            voce["errori"] += int(errore)
+            voce["totale_ms"] += durata_ms
+            voce["max_ms"] = max(voce["max_ms"], durata_ms)
+            voce["campioni"].append(durata_ms)
+
+    def riepilogo(self):
+        with self._lock:
+            riepilogo = {}
+            for endpoint, voce in self._dati.items():
+                campioni = sorted(voce["campioni"])
+
+                def percentile(p):
+                    return round(campioni[min(len(campioni) - 1, int(p * len(campioni)))], 2)
+
+                riepilogo[endpoint] = {
+                    "richieste": voce["richieste"],
+                    "errori": voce["errori"],
+                    "media_ms": round(voce["totale_ms"] / voce["richieste"], 2),
+                    "p50_ms": percentile(0.50),
+                    "p95_ms": percentile(0.95),
+                    "max_ms": round(voce["max_ms"], 2),
+                }
+            return riepilogo
+
+
+def _elenco_comuni(base_dir):
+    """Cartelle dei comuni: {(provincia, comune): percorso}."""
+    comuni = {}
+    if not os.path.isdir(base_dir):
+        return comuni
+    for provincia in sorted(os.listdir(base_dir)):
+        provincia_dir = os.path.join(base_dir, provincia)
+        if not os.path.isdir(provincia_dir):
+            continue
+        for comune in sorted(os.listdir(provincia_dir)):
+            comune_dir = os.path.join(provincia_dir, comune)
+            if os.path.isdir(comune_dir):
+                comuni[(provincia, comune)] = comune_dir
+    return comuni
+
+
+def _lista_particelle(valore):
+    """Particelle da stringa separata da virgole o da lista."""
+    if isinstance(valore, (list, tuple)):
+        return [str(p).strip() for p in valore if str(p).strip()]
+    return [p.strip() for p in str(valore or "").split(",") if p.strip()]
+
+
+class ServizioCatastale:
+    """Gruppo di worker caldi e instradamento delle richieste per comune."""
+
+    def __init__(self, base_dir=BASE_DIR, processi=2, limite_memoria_mb=LIMITE_MEMORIA_MB,
+                 comuni_per_worker=COMUNI_PER_WORKER):
+        self.base_dir = base_dir
+        self.comuni = _elenco_comuni(base_dir)
+        self.metriche = Metriche()
+        self._initargs = (limite_memoria_mb, comuni_per_worker)
+        self._lock_workers = threading.Lock()
+        # Un executor mono-processo per worker: lo stesso comune va sempre allo stesso processo
+        self.workers = [self._crea_worker() for _ in range(max(1, processi))]
+
+    def _crea_worker(self):
+        return ProcessPoolExecutor(max_workers=1, initializer=_inizializza_worker, initargs=self._initargs)
+
+    def chiudi(self):
+        for worker in self.workers:
+            worker.shutdown(wait=False, cancel_futures=True)
+
+    def _ricrea_worker(self, posizione, guasto):
+        """
+        Sostituisce l'executor guasto (processo terminato, es. memoria esaurita)
+        con uno nuovo; se un altro thread lo ha già sostituito non fa nulla.
+        """
+        with self._lock_workers:
+            if self.workers[posizione] is not guasto:
+                return
+            self.workers[posizione] = self._crea_worker()
+        guasto.shutdown(wait=False, cancel_futures=True)
+        print(f"Worker {posizione} terminato in modo anomalo: ricreato")
+
+    def _sottometti(self, comune_dir, funzione, *argomenti):
+        """
+        Sottomette funzione al worker del comune, ricreandolo se è guasto.
+        Un worker che termina durante l'elaborazione viene ricreato al
+        completamento del Future (che riporta BrokenExecutor al chiamante).
+        """
+        posizione = zlib.crc32(comune_dir.encode("utf-8")) % len(self.workers)
+        worker = self.workers[posizione]
+        try:
+            future = worker.submit(funzione, comune_dir, *argomenti)
+        except BrokenExecutor:
+            self._ricrea_worker(posizione, worker)
+            worker = self.workers[posizione]
+            future = worker.submit(funzione, comune_dir, *argomenti)
+
+        def controlla(f):
+            if not f.cancelled() and isinstance(f.exception(), BrokenExecutor):
+                self._ricrea_worker(posizione, worker)
+
+        future.add_done_callback(controlla)
+        return future
+
+    def risolvi_comune(self, provincia, comune):
+        """Cartella del comune; la provincia può mancare se il nome è univoco."""
+        provincia, comune = (provincia or "").strip(), (comune or "").strip()
+        if provincia:
+            comune_dir = self.comuni.get((provincia, comune))
+            if comune_dir:
+                return comune_dir
+            raise ValueError(f"Comune '{comune}' non trovato nella provincia '{provincia}'.")
+        candidati = [d for (_, c), d in self.comuni.items() if c == comune]
+        if len(candidati) == 1:
+            return candidati[0]
+        if not candidati:
+            raise ValueError(f"Comune '{comune}' non trovato.")
+        raise ValueError(f"Comune '{comune}' presente in più province: indicare la provincia.")
+
+    def precarica(self, comuni_dirs):
+        """
+        Carica i comuni nei rispettivi worker; ritorna {cartella: messaggio} dei
+        comuni non caricati (un comune non valido non blocca l'avvio).
+        """
+        futures = [(d, self._sottometti(d, _precarica_comune)) for d in comuni_dirs]
+        errori = {}
+        for comune_dir, future in futures:
+            try:
+                future.result()
+            except ErroreRicerca as e:
+                errori[comune_dir] = e.messaggio
+            except Exception as e:
+                # es. BrokenProcessPool: il worker è già stato ricreato da _sottometti
+                errori[comune_dir] = str(e) or type(e).__name__
+        return errori
+
+    def invia(self, richiesta):
+        """Valida la richiesta (dict) e la sottomette al worker del comune; ritorna un Future."""
+        foglio = str(richiesta.get("foglio") or "").strip()
+        particelle = _lista_particelle(richiesta.get("particelle"))
+        if not richiesta.get("comune") or not foglio or not particelle:
+            raise ValueError("Parametri richiesti: comune, foglio, particelle (provincia facoltativa).")
+        comune_dir = self.risolvi_comune(richiesta.get("provincia"), richiesta.get("comune"))
+        return self._sottometti(comune_dir, _esegui_ricerca, foglio, particelle)
+
+
+class _GestoreRichieste(BaseHTTPRequestHandler):
+    """Gestore HTTP: il servizio è accessibile come self.server.servizio."""
+
+    server_version = "GeocodificaCatastali/1.0"
+
+    def _rispondi(self, codice, corpo, inizio, endpoint, intestazioni=None, content_type="application/json"):
+        durata_ms = (time.perf_counter() - inizio) * 1000
+        self.server.servizio.metriche.registra(endpoint, durata_ms, errore=codice >= 400)
+        dati = corpo if isinstance(corpo, bytes) else corpo.encode("utf-8")
+        self.send_response(codice)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(dati)))
+        self.send_header("X-Tempo-Ms", f"{durata_ms:.2f}")
+        for nome, valore in (intestazioni or {}).items():
+            self.send_header(nome, str(valore))
+        self.end_headers()
+        self.wfile.write(dati)
+
+    def _rispondi_json(self, codice, oggetto, inizio, endpoint):
+        self._rispondi(codice, json.dumps(oggetto, ensure_ascii=False), inizio, endpoint)
+
+    @staticmethod
+    def _errore_worker(e):
+        """Corpo della risposta 500 per un worker guasto o un errore inatteso."""
+        if isinstance(e, BrokenExecutor):
+            return {"errore": "Worker non disponibile",
+                    "messaggio": "Il processo di elaborazione è terminato (es. memoria esaurita) ed è stato "
+                                 "riavviato: ripetere la richiesta."}
+        return {"errore": "Errore", "messaggio": str(e)}
+
+    @staticmethod
+    def _codice_esito(esito):
+        if esito["esito"] == "ok":
+            return 200
+        return 500 if esito.get("critico") else 404
+
+    def do_GET(self):
+        inizio = time.perf_counter()
+        url = urlparse(self.path)
+        servizio = self.server.servizio
+
+        if url.path == "/metriche":
+            self._rispondi_json(200, servizio.metriche.riepilogo(), inizio, url.path)
+            return
+
+        if url.path == "/comuni":
+            elenco = [{"provincia": p, "comune": c} for (p, c) in servizio.comuni]
+            self._rispondi_json(200, elenco, inizio, url.path)
+            return
+
+        if url.path != "/particelle":
+            self._rispondi_json(404, {"errore": "Endpoint non trovato"}, inizio, "altro")
+            return
+
+        parametri = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            esito = servizio.invia(parametri).result()
+        except ValueError as e:
+            self._rispondi_json(400, {"errore": "Richiesta non valida", "messaggio": str(e)}, inizio, url.path)
+            return
+        except Exception as e:
+            self._rispondi_json(500, self._errore_worker(e), inizio, url.path)
+            return
+
+        intestazioni = {"X-Tempo-Worker-Ms": esito["tempo_worker_ms"], "X-Cache": int(esito["cache"])}
+        if esito["esito"] != "ok":
+            corpo = {"errore": esito["titolo"], "messaggio": esito["messaggio"]}
+            self._rispondi(self._codice_esito(esito), json.dumps(corpo, ensure_ascii=False), inizio,
+                           url.path, intestazioni)
+            return
+        if esito["mancanti"]:
+            intestazioni["X-Particelle-Mancanti"] = ",".join(esito["mancanti"])
+        self._rispondi(200, esito["geojson"], inizio, url.path, intestazioni,
+                       content_type="application/geo+json")
+
+    def do_POST(self):
+        inizio = time.perf_counter()
+        url = urlparse(self.path)
+        endpoint = url.path + " (lotto)"
+        if url.path != "/particelle":
+            self._rispondi_json(404, {"errore": "Endpoint non trovato"}, inizio, "altro")
+            return
+
+        try:
+            lunghezza = int(self.headers.get("Content-Length", 0))
+            corpo = json.loads(self.rfile.read(lunghezza) or b"{}")
+            richieste = corpo.get("richieste") if isinstance(corpo, dict) else corpo
+            if not isinstance(richieste, list):
+                raise ValueError("Il corpo deve contenere l'elenco 'richieste'.")
+        except ValueError as e:
+            self._rispondi_json(400, {"errore": "Richiesta non valida", "messaggio": str(e)}, inizio, endpoint)
+            return
+
+        # Tutte le richieste sono sottomesse subito: i worker lavorano in parallelo
+        futures = []
+        for richiesta in richieste:
+            try:
+                futures.append((richiesta, self.server.servizio.invia(richiesta), None))
+            except (ValueError, AttributeError) as e:
+                futures.append((richiesta, None, (400, {"messaggio": str(e)})))
+            except Exception as e:
+                futures.append((richiesta, None, (500, self._errore_worker(e))))
+
+        risultati = []
+        for richiesta, future, errore in futures:
+            if future is not None:
+                try:
+                    esito = future.result()
+                except Exception as e:
+                    future, errore = None, (500, self._errore_worker(e))
+            if future is None:
+                codice, dettagli = errore
+                risultati.append({"richiesta": richiesta, "esito": "errore", "codice": codice, **dettagli})
+                continue
+            voce = {"richiesta": richiesta, "esito": esito["esito"], "codice": self._codice_esito(esito),
+                    "tempo_worker_ms": esito["tempo_worker_ms"], "cache": esito["cache"]}
+            if esito["esito"] == "ok":
+                voce["mancanti"] = esito["mancanti"]
+                voce["risultato"] = json.loads(esito["geojson"])
+            else:
+                voce["errore"] = esito["titolo"]
+                voce["messaggio"] = esito["messaggio"]
+            risultati.append(voce)
+
+        tempo_ms = round((time.perf_counter() - inizio) * 1000, 2)
+        self._rispondi_json(200, {"risultati": risultati, "tempo_ms": tempo_ms}, inizio, endpoint)
+
+    def log_message(self, format, *args):
+        print(f"[{self.log_date_time_string()}] {self.address_string()} {format % args}")
+
+
+def avvia_servizio(host=HOST_PREDEFINITO, porta=PORTA_PREDEFINITA, base_dir=BASE_DIR, processi=2,
+                   limite_memoria_mb=LIMITE_MEMORIA_MB, comuni_per_worker=COMUNI_PER_WORKER, precarica=()):
+    """Avvia il servizio (bloccante fino a Ctrl+C)."""
+    servizio = ServizioCatastale(base_dir, processi, limite_memoria_mb, comuni_per_worker)
+    server = ThreadingHTTPServer((host, porta), _GestoreRichieste)
+    server.servizio = servizio
+    try:
+        if precarica:
+            comuni_dirs = []
+            for voce in precarica:
+                try:
+                    comuni_dirs.append(servizio.risolvi_comune(*voce.split("/", 1)) if "/" in voce
+                                       else servizio.risolvi_comune(None, voce))
+                except ValueError as e:
+                    print(f"Precaricamento di '{voce}' non eseguito: {e}")
+            for comune_dir, messaggio in servizio.precarica(comuni_dirs).items():
+                print(f"Precaricamento di '{os.path.relpath(comune_dir, base_dir)}' non riuscito: {messaggio}")
+        print(f"Servizio catastale su http://{host}:{porta} ({len(servizio.workers)} worker, "
+              f"{len(servizio.comuni)} comuni)")
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        servizio.chiudi()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servizio locale HTTP/JSON per la ricerca di particelle catastali")
+    parser.add_argument("--host", default=HOST_PREDEFINITO)
+    parser.add_argument("--porta", type=int, default=PORTA_PREDEFINITA)
+    parser.add_argument("--dati", default=BASE_DIR, help="cartella Sardegna (Provincia -> Comune)")
+    parser.add_argument("--processi", type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument("--limite-memoria-mb", type=int, default=LIMITE_MEMORIA_MB)
+    parser.add_argument("--comuni-per-worker", type=int, default=COMUNI_PER_WORKER)
+    parser.add_argument("--precarica", nargs="*", default=[], metavar="PROVINCIA/COMUNE",
+                        help="comuni da caricare all'avvio")
+    args = parser.parse_args()
+    avvia_servizio(args.host, args.porta, args.dati, args.processi, args.limite_memoria_mb,
+                   args.comuni_per_worker, args.precarica)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo variazioni tra rilasci - Plugin Geocodifica Catastali
+In fase di scaricamento salva per ogni comune un'impronta compatta di ciascuna
+particella (foglio/particella normalizzati + hash a 64 bit del WKB della
+geometria normalizzata). Al rilascio successivo il confronto tra le impronte è
+un join vettoriale sulle etichette: particelle aggiunte, rimosse e modificate
+sono salvate in un report CSV per comune.
+"""
+
+import os
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from .lettura_catastale import scrittura_atomica
+
+
+# File nella cartella del comune
+NOME_IMPRONTE = "impronte_particelle.npz"
+NOME_IMPRONTE_PRECEDENTI = "impronte_particelle_precedenti.npz"
+NOME_VARIAZIONI = "variazioni_particelle.csv"
+
+# Riepilogo regionale dell'ultimo aggiornamento (nella cartella Sardegna)
+NOME_RIEPILOGO_VARIAZIONI = "variazioni_ultimo_aggiornamento.csv"
+
+STATI_VARIAZIONE = ("aggiunta", "modificata", "rimossa")
+
+_CHIAVI = ["FOGLIO", "PARTICELLA"]
+
+
+def calcola_impronte(particelle, firma):
+    """
+    Impronte delle particelle (risultato di leggi_particelle_con_fogli):
+    etichette e hash blake2b a 8 byte del WKB della geometria normalizzata
+    (indipendente da punto iniziale e verso degli anelli).
+    """
+    wkb = particelle.geometry.normalize().to_wkb().tolist()
+    hash_wkb = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(w or b"", digest_size=8).digest(), "little") for w in wkb),
+        dtype=np.uint64, count=len(wkb),
+    )
+    return {
+        "foglio": particelle["FOGLIO"].to_numpy().astype(str),
+        "particella": particelle["PARTICELLA"].to_numpy().astype(str),
+        "hash": hash_wkb,
+        "sorgenti": np.array(firma, dtype=np.int64),
+    }
+
+
+def _combina_hash(hash_parti):
+    """
+    Hash unico delle parti con la stessa etichetta: blake2b degli hash delle
+    parti ordinati (indipendente dall'ordine, ma parti uguali non si annullano).
+    """
+    dati = np.sort(np.asarray(hash_parti, dtype=np.uint64)).tobytes()
+    return np.uint64(int.from_bytes(hashlib.blake2b(dati, digest_size=8).digest(), "little"))
+
+
+def _tabella_impronte(impronte):
+    """DataFrame (FOGLIO, PARTICELLA, HASH, POSIZIONE) con una riga per etichetta."""
+    df = pd.DataFrame({
+        "FOGLIO": impronte["foglio"],
+        "PARTICELLA": impronte["particella"],
+        "HASH": impronte["hash"],
+        "POSIZIONE": np.arange(len(impronte["hash"]), dtype=np.int64),
+    })
+    # Etichette ripetute (più parti con la stessa etichetta): hash delle parti combinati
+    ripetute = df.duplicated(_CHIAVI, keep=False).to_numpy()
+    if ripetute.any():
+        gruppi = df[ripetute].groupby(_CHIAVI, sort=False).agg(
+            HASH=("HASH", _combina_hash), POSIZIONE=("POSIZIONE", "first")
+        ).reset_index()
+        gruppi["HASH"] = gruppi["HASH"].astype(np.uint64)
+        df = pd.concat([df[~ripetute], gruppi], ignore_index=True)
+    return df
+
+
+def confronta_impronte(precedenti, attuali):
+    """
+    Confronto vettoriale tra due rilasci. Ritorna un DataFrame con FOGLIO,
+    PARTICELLA, STATO (aggiunta/modificata/rimossa) e POSIZIONE della particella
+    nel _ple.gml attuale (-1 per le rimosse).
+    """
+    prec = _tabella_impronte(precedenti)
+    att = _tabella_impronte(attuali)
+
+    entrambe = prec.merge(att, on=_CHIAVI, suffixes=("_PREC", ""))
+    modificate = entrambe.loc[entrambe["HASH_PREC"] != entrambe["HASH"], _CHIAVI + ["POSIZIONE"]]
+
+    chiavi_prec = pd.MultiIndex.from_frame(prec[_CHIAVI])
+    chiavi_att = pd.MultiIndex.from_frame(att[_CHIAVI])
+    aggiunte = att.loc[~chiavi_att.isin(chiavi_prec), _CHIAVI + ["POSIZIONE"]]
+    rimosse = prec.loc[~chiavi_prec.isin(chiavi_att), _CHIAVI].assign(POSIZIONE=-1)
+
+    variazioni = pd.concat([
+        aggiunte.assign(STATO="aggiunta"),
+        modificate.assign(STATO="modificata"),
+        rimosse.assign(STATO="rimossa"),
+    ], ignore_index=True)[_CHIAVI + ["STATO", "POSIZIONE"]]
+
+    # Ordinamento vettoriale: stato, poi foglio e particella in ordine "naturale"
+    # (lunghezza, testo) come chiave_etichetta
+    ordinamento = pd.DataFrame({
+        "STATO": pd.Categorical(variazioni["STATO"], categories=STATI_VARIAZIONE, ordered=True),
+        "LUNG_FOGLIO": variazioni["FOGLIO"].str.len(),
+        "FOGLIO": variazioni["FOGLIO"],
+        "LUNG_PARTICELLA": variazioni["PARTICELLA"].str.len(),
+        "PARTICELLA": variazioni["PARTICELLA"],
+    })
+    ordine = ordinamento.sort_values(list(ordinamento.columns), kind="stable").index
+    return variazioni.loc[ordine].reset_index(drop=True)
+
+
+def _carica_impronte(path):
+    with np.load(path, allow_pickle=False) as dati:
+        return {k: dati[k] for k in dati.files}
+
+
+def aggiorna_impronte(comune_dir, letti):
+    """
+    Salva le impronte del rilascio attuale (letti = risultato di
+    leggi_particelle_con_fogli). Se esistono impronte di un rilascio precedente
+    scrive il report delle variazioni e ritorna i conteggi per stato;
+    ritorna None se non c'è un rilascio precedente con cui confrontare.
+    """
+    particelle, firma = letti
+    impronte_path = os.path.join(comune_dir, NOME_IMPRONTE)
+
+    precedenti = None
+    if os.path.exists(impronte_path):
+        try:
+            precedenti = _carica_impronte(impronte_path)
+        except Exception:
+            precedenti = None
+        if precedenti is not None and precedenti["sorgenti"].tolist() == firma:
+            return None  # impronte già allineate ai GML presenti
+
+    attuali = calcola_impronte(particelle, firma)
+
+    conteggi = None
+    if precedenti is not None:
+        variazioni = confronta_impronte(precedenti, attuali)
+        variazioni.to_csv(os.path.join(comune_dir, NOME_VARIAZIONI), index=False)
+        os.replace(impronte_path, os.path.join(comune_dir, NOME_IMPRONTE_PRECEDENTI))
+        conteggi = {stato: int((variazioni["STATO"] == stato).sum()) for stato in STATI_VARIAZIONE}
+
+    scrittura_atomica(impronte_path, lambda tmp_path: np.savez_compressed(tmp_path, **attuali))
+    return conteggi
+
+
+def carica_variazioni(comune_dir):
+    """Report delle variazioni dell'ultimo aggiornamento del comune (None se assente)."""
+    path = os.path.join(comune_dir, NOME_VARIAZIONI)
+    if not os.path.exists(path):
+        return None
+    return pd.read_csv(path, dtype={"FOGLIO": str, "PARTICELLA": str, "STATO": str, "POSIZIONE": np.int64},
+                       keep_default_na=False)
+
+
+def salva_riepilogo_variazioni(base_dir, riepilogo):
+    """Scrive il riepilogo regionale: una riga per comune con i conteggi per stato."""
+    righe = [{"PROVINCIA": provincia, "COMUNE": comune, **{s.upper(): n for s, n in conteggi.items()}}
+             for (provincia, comune), conteggi in riepilogo.items()]
+    pd.DataFrame(righe).to_csv(os.path.join(base_dir, NOME_RIEPILOGO_VARIAZIONI), index=False)